@@ -20,16 +20,32 @@
 
 from __future__ import print_function, division
 
+import os
 import sys
 import re
 import time
-from threading import Thread
-from collections import defaultdict
+import marshal
+from collections import defaultdict, deque, OrderedDict
+from threading import RLock
+from repoze.lru import LRUCache
 from util import parse_hostport
+from timer_wheel import timer
 try:
     import urlparse
 except ImportError:
     import urllib.parse as urlparse
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+# rule text passed to the regex unescaped, such rules are compiled at once so bad ones fail early
+_unsafe = re.compile(r'[()\[\]{}+\\$]|[*?]\?').search
+
+
+def _intern(s):
+    # python 2 interns str only
+    return intern(s) if isinstance(s, str) else s
 
 
 class ExpiredError(Exception):
@@ -37,39 +53,238 @@ class ExpiredError(Exception):
         self.rule = rule
 
 
+class domain_trie(object):
+    '''reversed-label trie: www.google.com is stored as com -> google -> www'''
+
+    def __init__(self):
+        self.root = {}
+        self.count = 0
+
+    def add(self, domain, value):
+        node = self.root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        values = node.setdefault(None, set())
+        if value not in values:
+            values.add(value)
+            self.count += 1
+
+    def discard(self, domain, value):
+        node = self.root
+        path = []
+        for label in reversed(domain.split('.')):
+            path.append((node, label))
+            node = node.get(label)
+            if node is None:
+                return
+        values = node.get(None)
+        if not values or value not in values:
+            return
+        values.discard(value)
+        self.count -= 1
+        if not values:
+            del node[None]
+        # prune empty branches
+        while path and not node:
+            parent, label = path.pop()
+            del parent[label]
+            node = parent
+
+    def match(self, host):
+        '''return values stored on the deepest domain host belongs to'''
+        node = self.root
+        result = None
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            # read once, rules expire from the timer thread
+            values = node.get(None)
+            if values:
+                result = values
+        return result
+
+    def match_all(self, host):
+        '''return values stored on every domain host belongs to, the deepest last'''
+        node = self.root
+        result = []
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            values = node.get(None)
+            if values:
+                # a copy, values may change while the caller loops over them
+                result.append(tuple(values))
+        return result
+
+    def __len__(self):
+        return self.count
+
+
+class prefix_trie(object):
+    '''path-segment trie for url prefixes.
+
+    http://www.google.com/search is stored as http: -> '' -> www.google.com,
+    with 'search' kept as a partial segment on the last node.
+    '''
+
+    def __init__(self):
+        self.root = {}
+        self.count = 0
+
+    def add(self, prefix):
+        segs = prefix.split('/')
+        node = self.root
+        for seg in segs[:-1]:
+            node = node.setdefault(seg, {})
+        tails = node.setdefault(None, set())
+        if segs[-1] not in tails:
+            tails.add(segs[-1])
+            self.count += 1
+
+    def discard(self, prefix):
+        segs = prefix.split('/')
+        node = self.root
+        path = []
+        for seg in segs[:-1]:
+            path.append((node, seg))
+            node = node.get(seg)
+            if node is None:
+                return
+        tails = node.get(None)
+        if not tails or segs[-1] not in tails:
+            return
+        tails.discard(segs[-1])
+        self.count -= 1
+        if not tails:
+            del node[None]
+        while path and not node:
+            parent, seg = path.pop()
+            del parent[seg]
+            node = parent
+
+    def match(self, url):
+        segs = url.split('/')
+        node = self.root
+        for seg in segs:
+            tails = node.get(None)
+            # a copy, prefixes may be removed while matching
+            if tails and any(seg.startswith(tail) for tail in tuple(tails)):
+                return True
+            node = node.get(seg)
+            if node is None:
+                return False
+        return False
+
+    def __iter__(self):
+        stack = [(self.root, [])]
+        while stack:
+            node, segs = stack.pop()
+            for seg, child in node.items():
+                if seg is None:
+                    for tail in child:
+                        yield '/'.join(segs + [tail])
+                else:
+                    stack.append((child, segs + [seg]))
+
+    def __len__(self):
+        return self.count
+
+
+class ac_automaton(object):
+    '''Aho-Corasick automaton, find all keywords in a string in one pass'''
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for word in keywords:
+            node = 0
+            for char in word:
+                nxt = self.goto[node].get(char)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][char] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                node = nxt
+            self.output[node] += (word, )
+        # breadth first, children of root fail to root
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and char not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(char, 0)
+                self.output[nxt] += self.output[self.fail[nxt]]
+
+    def search(self, text):
+        '''return keywords found in text, in order of their end position'''
+        goto, fail, output = self.goto, self.fail, self.output
+        node = 0
+        result = []
+        for char in text:
+            nxt = goto[node].get(char)
+            while nxt is None and node:
+                node = fail[node]
+                nxt = goto[node].get(char)
+            node = nxt or 0
+            if output[node]:
+                result.extend(output[node])
+        return result
+
+
 class ap_rule(object):
+    __slots__ = ('rule', 'msg', 'expire', 'override', 'options', '_pattern', '_compiled')
 
-    def __init__(self, rule, msg=None, expire=None):
+    def __init__(self, rule, msg=None, expire=None, regex=None):
+        '''regex: pattern of a parsed rule, skip parsing if provided.
+
+        the pattern is compiled on first match, unless it may be invalid.
+        '''
         super(ap_rule, self).__init__()
-        self.rule = rule.strip()
+        self.rule = _intern(rule.strip())
         if len(self.rule) < 3 or self.rule.startswith(('!', '[')) or '#' in self.rule or ' ' in self.rule:
             raise ValueError("invalid abp_rule: %s" % self.rule)
         self.msg = msg
         self.expire = expire
         self.override = self.rule.startswith('@@')
-        self._regex = self._parse()
+        text, self.options = _split_options(self.rule) if '$' in self.rule else (self.rule, None)
+        self._pattern = regex or self._parse(text)
+        self._compiled = None
+        if not regex and (text.lstrip('@').startswith('/') or _unsafe(text)):
+            self._compiled = re.compile(self._pattern)
+
+    @property
+    def _regex(self):
+        if self._compiled is None:
+            self._compiled = re.compile(self._pattern)
+        return self._compiled
 
-    def _parse(self):
+    def _parse(self, text):
         def parse(rule):
             if rule.startswith('||'):
-                regex = rule.replace('.', r'\.').replace('?', r'\?').replace('/', '').replace('*', '[^/]*').replace('^', '').replace('||', '^(?:https?://)?(?:[^/]+\.)?') + r'(?:[:/]|$)'
-                return re.compile(regex)
+                return rule.replace('.', r'\.').replace('?', r'\?').replace('/', '').replace('*', '[^/]*').replace('^', '').replace('||', '^(?:https?://)?(?:[^/]+\.)?') + r'(?:[:/]|$)'
             elif rule.startswith('/') and rule.endswith('/'):
-                return re.compile(rule[1:-1])
+                return rule[1:-1]
             elif rule.startswith('|https://'):
                 i = rule.find('/', 9)
                 regex = rule[9:] if i == -1 else rule[9:i]
-                regex = r'^(?:https://)?%s(?:[:/])' % regex.replace('.', r'\.').replace('*', '[^/]*')
-                return re.compile(regex)
+                return r'^(?:https://)?%s(?:[:/])' % regex.replace('.', r'\.').replace('*', '[^/]*')
             else:
                 regex = rule.replace('.', r'\.').replace('?', r'\?').replace('*', '.*').replace('^', r'[\/:]')
                 regex = re.sub(r'^\|', r'^', regex)
                 regex = re.sub(r'\|$', r'$', regex)
                 if not rule.startswith(('|', 'http://')):
                     regex = re.sub(r'^', r'^http://.*', regex)
-                return re.compile(regex)
+                return regex
 
-        return parse(self.rule[2:]) if self.override else parse(self.rule)
+        return parse(text[2:]) if self.override else parse(text)
 
     def match(self, uri):
         if self.expire and self.expire < time.time():
@@ -82,163 +297,824 @@ class ap_rule(object):
         return '<ap_rule: %s>' % self.rule
 
 
+class rule_options(object):
+    '''adblock "$" options: domain=, third-party, important, script and image guessed from path'''
+    __slots__ = ('domains', 'third_party', 'types', 'not_types', 'important')
+    TYPES = {'script': ('.js', ),
+             'image': ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.svg', '.ico', '.bmp'),
+             }
+
+    def __init__(self, text):
+        self.domains = None  # domain of the page: True to apply, False to skip
+        self.third_party = None
+        self.types = set()
+        self.not_types = set()
+        self.important = False
+        for opt in text.split(','):
+            if opt.startswith('domain='):
+                self.domains = {}
+                for domain in opt[7:].split('|'):
+                    if domain.startswith('~'):
+                        self.domains[domain[1:]] = False
+                    else:
+                        self.domains[domain] = True
+            elif opt in ('third-party', '3p', '~first-party'):
+                self.third_party = True
+            elif opt in ('~third-party', '1p', 'first-party'):
+                self.third_party = False
+            elif opt in self.TYPES:
+                self.types.add(opt)
+            elif opt.startswith('~') and opt[1:] in self.TYPES:
+                self.not_types.add(opt[1:])
+            elif opt == 'important':
+                self.important = True
+            elif opt != 'match-case':
+                raise ValueError('unsupported rule option: %s' % opt)
+
+    def check(self, url, host, page=None):
+        '''host: host of the request, page: host of the page sending it, None if unknown'''
+        if self.types or self.not_types:
+            kind = _request_type(url)
+            if self.types and kind not in self.types:
+                return False
+            if kind in self.not_types:
+                return False
+        if self.third_party is not None:
+            third_party = page is not None and _base_domain(host) != _base_domain(page)
+            if third_party != self.third_party:
+                return False
+        if self.domains:
+            labels = page.split('.') if page else []
+            for i in range(len(labels)):
+                value = self.domains.get('.'.join(labels[i:]))
+                if value is not None:
+                    return value
+            return True not in self.domains.values()
+        return True
+
+
+def _split_options(rule):
+    '''return rule text without "$" options, and the options parsed'''
+    text, _, opts = rule.rpartition('$')
+    if not text or not re.match(r'^~?[\w-]+(=[^,]*)?(,~?[\w-]+(=[^,]*)?)*$', opts):
+        return rule, None
+    return text, rule_options(opts)
+
+
+def _request_type(url):
+    parts = url.split('/', 3)
+    path = parts[3].split('?', 1)[0].split('#', 1)[0].lower() if len(parts) == 4 else ''
+    for kind, exts in rule_options.TYPES.items():
+        if path.endswith(exts):
+            return kind
+    return 'other'
+
+
+def _base_domain(host):
+    '''www.example.com -> example.com, www.example.co.uk -> example.co.uk'''
+    labels = host.split('.')
+    if labels[-1].isdigit():
+        return host
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in ('com', 'net', 'org', 'co', 'gov', 'edu', 'ac', 'or', 'ne', 'go'):
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def _host_of(url):
+    if '://' in url:
+        return urlparse.urlparse(url).hostname
+    return parse_hostport(url)[0]  # www.google.com:443
+
+
+def _literal(rule):
+    '''longest part of a rule matched literally, None if the rule may carry regex syntax'''
+    if any(c in rule for c in '+()[]{}\\'):
+        return None
+    return max(re.split(r'[*^|]', rule), key=len)
+
+
+def _strip_anchor(pattern):
+    '''"^foo" -> "foo" if the leading "^" anchors the whole pattern, else None'''
+    if not pattern.startswith('^'):
+        return None
+    depth = 0
+    escape = charset = False
+    for c in pattern:
+        if escape:
+            escape = False
+        elif c == '\\':
+            escape = True
+        elif charset:
+            charset = c != ']'
+        elif c == '[':
+            charset = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and depth == 0:
+            return None
+    return pattern[1:]
+
+
+class regex_set(object):
+    '''ap_rules merged into a few alternation regexes, recompiled lazily after changes'''
+    CHUNK = 99  # python 2.7 supports 100 groups at most
+
+    def __init__(self):
+        self.rules = {}
+        self._compiled = None
+        # temporary rules are removed from the timer thread, a compile must not see half a change
+        self.lock = RLock()
+
+    def add(self, o):
+        with self.lock:
+            self.rules[o.rule] = o
+            self._compiled = None
+
+    def remove(self, rule):
+        with self.lock:
+            o = self.rules.pop(rule, None)
+            self._compiled = None
+        return o
+
+    def compile(self):
+        with self.lock:
+            if self._compiled is None:
+                self._compiled = self._compile(list(self.rules.values()))
+            return self._compiled
+
+    def _compile(self, rules):
+        combined, rest, anchored, unanchored = [], [], [], []
+        for o in rules:
+            pattern = o._regex.pattern
+            # numbered groups and inline flags do not survive merging
+            if o._regex.groups or re.search(r'\(\?[aiLmsux]', pattern):
+                rest.append(o)
+            elif _strip_anchor(pattern) is not None:
+                # tried at position 0 only, like the "^" they begin with
+                anchored.append((_strip_anchor(pattern), o))
+            else:
+                unanchored.append((pattern, o))
+        for lst, anchor in ((anchored, True), (unanchored, False)):
+            for i in range(0, len(lst), self.CHUNK):
+                chunk = lst[i:i + self.CHUNK]
+                try:
+                    regex = re.compile('|'.join('(?P<r%d>%s)' % (j, pattern) for j, (pattern, _) in enumerate(chunk)))
+                except Exception:
+                    rest.extend(o for _, o in chunk)
+                    continue
+                combined.append((regex.match if anchor else regex.search, [o for _, o in chunk]))
+        return combined, rest
+
+    def match(self, url):
+        '''return the ap_rule matching url, or None'''
+        combined, rest = self._compiled or self.compile()
+        for func, chunk in combined:
+            m = func(url)
+            if m:
+                return chunk[int(m.lastgroup[1:])]
+        for o in rest:
+            if o.match(url):
+                return o
+
+    def __iter__(self):
+        return iter(list(self.rules.values()))
+
+    def __len__(self):
+        return len(self.rules)
+
+
+class glob_set(object):
+    '''host glob rules like "||img*.example.com", bucketed by the labels they end with.
+
+    only rules bucketed on a domain the host belongs to are tried.
+    '''
+
+    def __init__(self):
+        self.trie = domain_trie()  # suffix: rule
+        self.rules = {}
+
+    def add(self, o, suffix):
+        self.rules[o.rule] = o
+        self.trie.add(suffix, o.rule)
+
+    def remove(self, rule, suffix):
+        self.trie.discard(suffix, rule)
+        return self.rules.pop(rule, None)
+
+    def match(self, url, host):
+        if not self.rules:
+            return None
+        for bucket in self.trie.match_all(host):
+            for rule in bucket:
+                o = self.rules.get(rule)
+                # None if removed since match_all()
+                if o is not None and o.match(url):
+                    return o
+
+    def __iter__(self):
+        return iter(list(self.rules.values()))
+
+    def __len__(self):
+        return len(self.rules)
+
+
 class ap_filter(object):
+    SNAPSHOT_VERSION = 4
     KEYLEN = 6
+    ENGINE = 'ac'  # keyword engine for fast rules, 'ac' or 'window'
+    CACHE_SIZE = 1024  # match results cached per filter, 0 to disable
 
-    def __init__(self, lst=None):
-        self.excludes = []
-        self.slow = []
-        self.domains = set()
-        self.exclude_domains = set()
-        self.url_startswith = tuple()
-        self.fast = defaultdict(list)
+    def __init__(self, lst=None, engine=None, cache_size=None):
+        self.engine = engine or self.ENGINE
+        if self.engine not in ('ac', 'window'):
+            raise ValueError('unknown ap_filter engine: %s' % self.engine)
+        cache_size = self.CACHE_SIZE if cache_size is None else cache_size
+        self._cache = LRUCache(cache_size) if cache_size else None
+        # bumped on every change, cached results of older generations are ignored
+        self.generation = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.excludes = regex_set()
+        self.slow = regex_set()
+        self.exclude_globs = glob_set()
+        self.globs = glob_set()
+        # rules with "$" options, options are checked on rules matching the url only
+        self.important = rule_table()
+        self.optioned_excludes = rule_table()
+        self.optioned = rule_table()
+        self.domains = domain_trie()  # True for "||", False for "@@||"
+        self.url_startswith = prefix_trie()
+        self.fast = defaultdict(dict)  # last KEYLEN chars of keyword: {rule: ap_rule}, for 'window'
+        self.keywords = defaultdict(dict)  # keyword: {rule: ap_rule}, for 'ac'
+        self._automaton = None
+        self.keyword_generation = 0  # bumped when keywords change, see rule_engine
+        self.keyword_lock = RLock()  # held while keywords change, see rule_engine._build()
+        # held by add() and remove(): temporary rules come from request threads and expire from the timer thread.
+        # match() takes no lock, indexes are changed so a concurrent reader sees either state
+        self.lock = RLock()
         self.rules = set()
         self.expire = {}
+        self._expire_timers = {}
+        self._index = {}  # rule: (bucket, key), find a rule without classifying it again
         if lst:
             for rule in lst:
                 self.add(rule)
 
     def add(self, rule, expire=None):
-        rule = rule.strip()
-        if len(rule) < 3 or rule.startswith(('!', '[')) or '#' in rule or '$' in rule:
+        rule = _intern(rule.strip())
+        if len(rule) < 3 or rule.startswith(('!', '[')) or '#' in rule:
             return
-        if '||' in rule and '/' in rule[:-1]:
-            return self.add(rule.replace('||', '|http://'))
-        if rule.startswith('||') and '*' not in rule:
-            self._add_domain(rule)
+        with self.lock:
+            self._add(rule, expire)
+
+    def _add(self, rule, expire):
+        text = rule.rpartition('$')[0] if '$' in rule else rule
+        if '||' in text and '/' in text[:-1]:
+            return self._add(rule.replace('||', '|http://'), expire)
+        if '$' in rule:
+            o = ap_rule(rule)
+            if o.options is None:
+                return
+            index = self._add_optioned(o)
+        elif rule.startswith('||') and '*' not in rule:
+            index = self._add_domain(rule[2:].rstrip('/^'), True)
         elif rule.startswith('@@||') and '*' not in rule:
-            self._add_exclude_domain(rule)
+            index = self._add_domain(rule[4:].rstrip('/^'), False)
+        elif self._glob_suffix(rule):
+            index = self._add_glob(ap_rule(rule), self._glob_suffix(rule))
         elif rule.startswith(('|https://', '@', '/')):
-            self._add_slow(rule)
-        elif rule.startswith('|http://') and any(len(s) > (self.KEYLEN) for s in rule.split('*')):
-            self._add_fast(rule)
-        elif rule.startswith('|http://') and '*' not in rule:
-            self._add_urlstartswith(rule)
-        elif any(len(s) > (self.KEYLEN) for s in rule.split('*')):
-            self._add_fast(rule)
+            index = self._add_slow(ap_rule(rule))
+        elif self._plain_prefix(rule):
+            index = self._add_urlstartswith(rule[1:])
+        elif self._keyword(rule):
+            index = self._add_fast(ap_rule(rule), self._keyword(rule))
         else:
-            self._add_slow(rule)
+            index = self._add_slow(ap_rule(rule))
+        self._index[rule] = index
         self.rules.add(rule)
         self.expire[rule] = expire
+        self.generation += 1
+        handle = self._expire_timers.pop(rule, None)
+        if handle:
+            timer.cancel(handle)
         if expire:
-            Thread(target=self.remove, args=(rule, expire)).start()
-
-    def _add_urlstartswith(self, rule):
-        temp = set(self.url_startswith)
-        temp.add(rule[1:])
-        self.url_startswith = tuple(temp)
-
-    def _add_fast(self, rule):
-        rule_t = rule[1:] if rule.startswith('|') else rule
-        lst = [s for s in rule_t.split('*') if len(s) > self.KEYLEN]
-        o = ap_rule(rule)
-        key = lst[-1][self.KEYLEN * -1:]
-        self.fast[key].append(o)
-
-    def _add_slow(self, rule):
-        o = ap_rule(rule)
-        lst = self.excludes if o.override else self.slow
-        lst.append(o)
-
-    def _add_exclude_domain(self, rule):
-        rule = rule.rstrip('/^')
-        self.exclude_domains.add(rule[4:])
-
-    def _add_domain(self, rule):
-        rule = rule.rstrip('/^')
-        self.domains.add(rule[2:])
-
-    def match(self, url, host=None, domain_only=False):
+            self._expire_timers[rule] = timer.call_later(expire, self.remove, rule)
+
+    def _add_urlstartswith(self, prefix):
+        self.url_startswith.add(prefix)
+        return ('url_startswith', prefix)
+
+    @staticmethod
+    def _plain_prefix(rule):
+        '''"|http://" rule matching a literal url prefix, checked before keywords:
+        nearly all of them have a keyword long enough for the fast index'''
+        return rule.startswith('|http://') and _literal(rule) is not None and\
+            not any(c in rule[1:] for c in '*^|')
+
+    @classmethod
+    def _keyword(cls, rule):
+        '''longest part of the rule matched literally, None if not longer than KEYLEN'''
+        key = _literal(rule)
+        if key and len(key) > cls.KEYLEN:
+            return key
+
+    def _add_optioned(self, o):
+        if o.options.important and not o.override:
+            bucket = 'important'
+        else:
+            bucket = 'optioned_excludes' if o.override else 'optioned'
+        getattr(self, bucket).add(o, o.options)
+        return (bucket, None)
+
+    @classmethod
+    def _glob_suffix(cls, rule):
+        '''domain a "||" or "|https://" host glob rule is limited to, None if not a host glob'''
+        if rule.startswith('@@'):
+            rule = rule[2:]
+        if rule.startswith('||'):
+            host = rule[2:].rstrip('/^')
+        elif rule.startswith('|https://'):
+            host = rule[9:].split('/', 1)[0]
+        else:
+            return None
+        if not re.match(r'^[\w.*-]+$', host):
+            return None
+        if '*' not in host:
+            return host
+        # labels after the last "*", the first one may be partial: img*.example.com
+        labels = host.rsplit('*', 1)[1].split('.')[1:]
+        if labels and '' not in labels:
+            return '.'.join(labels)
+
+    def _add_glob(self, o, suffix):
+        bucket = 'exclude_globs' if o.override else 'globs'
+        getattr(self, bucket).add(o, suffix)
+        return (bucket, suffix)
+
+    def _add_fast(self, o, keyword):
+        with self.keyword_lock:
+            self.fast[keyword[-self.KEYLEN:]][o.rule] = o
+            self.keywords[keyword][o.rule] = o
+            self._automaton = None
+            self.keyword_generation += 1
+        return ('fast', keyword)
+
+    def _add_slow(self, o):
+        bucket = 'excludes' if o.override else 'slow'
+        getattr(self, bucket).add(o)
+        return (bucket, None)
+
+    def _add_domain(self, domain, value):
+        self.domains.add(domain, value)
+        return ('domains', (domain, value))
+
+    def match(self, url, host=None, domain_only=False, page=None, shared=None):
+        '''page: host of the page sending the request, for rules with "$" options
+        shared: rule_query to take keywords found in url from
+        '''
+        if self._cache is None:
+            return self._match(url, host, domain_only, page, shared)
+        key = (url, host, domain_only, page)
+        generation = self.generation
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == generation:
+            self.cache_hits += 1
+            return cached[1]
+        self.cache_misses += 1
+        result = self._match(url, host, domain_only, page, shared)
+        self._cache.put(key, (generation, result))
+        return result
+
+    def cache_info(self):
+        return {'size': self._cache.size if self._cache else 0,
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'generation': self.generation}
+
+    def index_info(self):
+        '''rules held by each index, "regex" rules are tried on every query'''
+        return {'domains': len(self.domains),
+                'url_startswith': len(self.url_startswith),
+                'fast': sum(len(v) for v in self.keywords.values()),
+                'globs': len(self.globs) + len(self.exclude_globs),
+                'optioned': len(self.important) + len(self.optioned_excludes) + len(self.optioned),
+                'regex': len(self.slow) + len(self.excludes)}
+
+    def memory_info(self):
+        '''approximate bytes held by ap_rule objects, including regexes compiled so far'''
+        count = compiled = size = 0
+        for o in self._ap_rules():
+            count += 1
+            size += sys.getsizeof(o) + sys.getsizeof(o.rule) + sys.getsizeof(o._pattern)
+            if o._compiled is not None:
+                compiled += 1
+                size += sys.getsizeof(o._compiled)
+        return {'ap_rules': count,
+                'compiled': compiled,
+                'bytes': size,
+                'bytes_per_rule': size // count if count else 0}
+
+    def _ap_rules(self):
+        for lst in (self.slow, self.excludes, self.globs, self.exclude_globs):
+            for o in lst:
+                yield o
+        for table in (self.important, self.optioned_excludes, self.optioned):
+            for o, _ in table:
+                yield o
+        for lst in self.keywords.values():
+            for o in lst.values():
+                yield o
+
+    def _match(self, url, host=None, domain_only=False, page=None, shared=None):
         if host is None:
-            if '://' in url:
-                host = urlparse.urlparse(url).hostname
-            else:  # www.google.com:443
-                host = parse_hostport(url)[0]
+            host = _host_of(url)
         if '://' not in url:
             url = 'https://%s/' % host
-        if self._listmatch(self.excludes, url):
+        if not domain_only and self._optionmatch(self.important, url, host, page, shared):
+            return True
+        if self.excludes.match(url) or self.exclude_globs.match(url, host):
+            return False
+        if self._optionmatch(self.optioned_excludes, url, host, page, shared):
             return False
-        if self._domainmatch(host) is not None:
-            return self._domainmatch(host)
+        result = self._domainmatch(host)
+        if result is not None:
+            return result
         if domain_only:
             return None
-        if url.startswith(self.url_startswith):
+        if self.url_startswith and self.url_startswith.match(url):
+            return True
+        if self.globs.match(url, host):
+            return True
+        if self._fastmatch(url, shared):
             return True
-        if self._fastmatch(url):
+        if self.slow.match(url):
             return True
-        if self._listmatch(self.slow, url):
+        if self._optionmatch(self.optioned, url, host, page, shared):
             return True
 
+    def _optionmatch(self, table, url, host, page, shared=None):
+        if not table:
+            return None
+        for o, options in table.candidates(url, host, shared):
+            if o.match(url) and options.check(url, host, page):
+                return o
+
     def _domainmatch(self, host):
-        lst = ['.'.join(host.split('.')[i:]) for i in range(len(host.split('.')))]
-        if any(host in self.exclude_domains for host in lst):
-            return False
-        if any(host in self.domains for host in lst):
-            return True
+        # the most specific rule wins, "@@||" wins on the same domain
+        values = self.domains.match(host)
+        if values:
+            return False not in values
 
-    def _fastmatch(self, url):
+    def _fastmatch(self, url, shared=None):
+        found = shared.search(url, self) if shared and url.startswith('http://') else None
+        if found is not None:
+            for keyword in found:
+                lst = self.keywords.get(keyword)
+                if lst and self._listmatch(lst.values(), url):
+                    return True
+            return None
+        if self.engine == 'window':
+            return self._fastmatch_window(url)
+        return self._fastmatch_ac(url)
+
+    def _fastmatch_ac(self, url):
+        if url.startswith('http://') and self.keywords:
+            automaton = self._automaton
+            if automaton is None:
+                automaton = self._automaton = ac_automaton(list(self.keywords))
+            for keyword in automaton.search(url):
+                if self._listmatch(self.keywords.get(keyword, {}).values(), url):
+                    return True
+
+    def _fastmatch_window(self, url):
         if url.startswith('http://'):
             i, j = 0, self.KEYLEN
             while j <= len(url):
                 s = url[i:j]
                 if s in self.fast:
-                    if self._listmatch(self.fast[s], url):
+                    if self._listmatch(self.fast[s].values(), url):
                         return True
                 i, j = i + 1, j + 1
 
     def _listmatch(self, lst, url):
         return any(r.match(url) for r in lst)
 
-    def remove(self, rule, delay=None):
-        if delay:
-            time.sleep(delay)
-        if rule in self.rules:
-            if rule.startswith('||') and '*' not in rule:
-                rule = rule.rstrip('/')
-                self.domains.discard(rule[2:])
-            elif rule.startswith('@@||') and '*' not in rule:
-                rule = rule.rstrip('/')
-                self.exclude_domains.discard(rule[4:])
-            elif rule.startswith(('|https://', '@', '/')):
-                lst = self.excludes if rule.startswith('@') else self.slow
-                for o in lst[:]:
-                    if o.rule == rule:
-                        lst.remove(o)
-                        break
-            elif rule.startswith('|http://') and any(len(s) > (self.KEYLEN) for s in rule[1:].split('*')):
-                rule_t = rule[1:]
-                lst = [s for s in rule_t.split('*') if len(s) > self.KEYLEN]
-                key = lst[-1][self.KEYLEN * -1:]
-                for o in self.fast[key][:]:
-                    if o.rule == rule:
-                        self.fast[key].remove(o)
-                        if not self.fast[key]:
-                            del self.fast[key]
-                        break
-            elif rule.startswith('|http://') and '*' not in rule:
-                temp = set(self.url_startswith)
-                temp.discard(rule[1:])
-                self.url_startswith = tuple(temp)
-            elif any(len(s) > (self.KEYLEN) for s in rule.split('*')):
-                lst = [s for s in rule.split('*') if len(s) > self.KEYLEN]
-                key = lst[-1][self.KEYLEN * -1:]
-                for o in self.fast[key][:]:
-                    if o.rule == rule:
-                        self.fast[key].remove(o)
-                        if not self.fast[key]:
-                            del self.fast[key]
-                        break
-            else:
-                lst = self.excludes if rule.startswith('@') else self.slow
-                for o in lst[:]:
-                    if o.rule == rule:
-                        lst.remove(o)
-                        break
+    def _snapshot_header(self, digest):
+        return (self.SNAPSHOT_VERSION, self.KEYLEN, tuple(sys.version_info[:2]), digest)
+
+    def dump(self, path, digest):
+        '''save built indexes to path, digest identifies the source rule list'''
+        if any(self.expire.values()):
+            raise ValueError('ap_filter with temporary rules can not be saved')
+        automaton = self._automaton
+        if automaton is None and self.keywords:
+            automaton = self._automaton = ac_automaton(list(self.keywords))
+        patterns = dict((o.rule, o._pattern) for o in self._ap_rules())
+        data = {'index': self._index,
+                'domains': (self.domains.root, self.domains.count),
+                'automaton': (automaton.goto, automaton.fail, automaton.output) if automaton else None,
+                'patterns': patterns,
+                }
+        with open(path + '.tmp', 'wb') as f:
+            marshal.dump(self._snapshot_header(digest), f)
+            marshal.dump(data, f)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def load(self, path, digest):
+        '''load indexes saved by dump(), return False if missing or out of date'''
+        try:
+            with open(path, 'rb') as f:
+                if marshal.load(f) != self._snapshot_header(digest):
+                    return False
+                data = marshal.load(f)
+        except Exception:
+            return False
+        self.__init__(engine=self.engine, cache_size=self._cache.size if self._cache else 0)
+        self.domains.root, self.domains.count = data['domains']
+        patterns = data['patterns']
+        for rule, index in data['index'].items():
+            bucket, key = index
+            if bucket == 'fast':
+                self._add_fast(ap_rule(rule, regex=patterns[rule]), key)
+            elif bucket in ('slow', 'excludes'):
+                self._add_slow(ap_rule(rule, regex=patterns[rule]))
+            elif bucket in ('globs', 'exclude_globs'):
+                self._add_glob(ap_rule(rule, regex=patterns[rule]), key)
+            elif bucket in ('important', 'optioned_excludes', 'optioned'):
+                self._add_optioned(ap_rule(rule, regex=patterns[rule]))
+            elif bucket == 'url_startswith':
+                self._add_urlstartswith(key)
+            self._index[rule] = (bucket, key)
+        if data['automaton']:
+            self._automaton = ac_automaton([])
+            self._automaton.goto, self._automaton.fail, self._automaton.output = data['automaton']
+        self.rules = set(self._index)
+        self.expire = dict.fromkeys(self.rules)
+        return True
+
+    def _remove_index(self, rule, index):
+        bucket, key = index
+        if bucket == 'domains':
+            self.domains.discard(*key)
+        elif bucket == 'url_startswith':
+            self.url_startswith.discard(key)
+        elif bucket == 'fast':
+            with self.keyword_lock:
+                for lst, k in ((self.fast, key[-self.KEYLEN:]), (self.keywords, key)):
+                    lst[k].pop(rule, None)
+                    if not lst[k]:
+                        del lst[k]
+                self._automaton = None
+                self.keyword_generation += 1
+        elif bucket in ('globs', 'exclude_globs'):
+            getattr(self, bucket).remove(rule, key)
+        else:
+            getattr(self, bucket).remove(rule)
+
+    def remove(self, rule):
+        with self.lock:
+            if rule not in self.rules:
+                return
+            handle = self._expire_timers.pop(rule, None)
+            if handle:
+                timer.cancel(handle)
+            self._remove_index(rule, self._index.pop(rule))
             self.rules.discard(rule)
             del self.expire[rule]
-            if '-GUI' in sys.argv:
-                sys.stdout.write('\n')
-                sys.stdout.flush()
+            self.generation += 1
+        if '-GUI' in sys.argv:
+            sys.stdout.write('\n')
+            sys.stdout.flush()
+
+
+class rule_table(object):
+    '''ordered (ap_rule, value) pairs, the first rule matching a url wins.
+
+    rules limited to a domain are indexed by it, rules with a literal keyword
+    by the keyword, only those found for a url are tried with the rest.
+    '''
+    KEYLEN = 3
+
+    def __init__(self):
+        self._entries = OrderedDict()  # seq: (ap_rule, value)
+        self._seq = {}  # rule: seq
+        self._where = {}  # seq: (bucket, key)
+        self._seq_next = 0
+        self.domains = domain_trie()  # domain: seq
+        self.keywords = defaultdict(set)  # keyword: seqs
+        self.rest = set()
+        self._automaton = None
+        self.keyword_generation = 0
+        self.keyword_lock = RLock()
+
+    def add(self, o, value):
+        if o.rule in self._seq:
+            self.remove(o.rule)
+        seq = self._seq_next
+        self._seq_next += 1
+        self._entries[seq] = (o, value)
+        self._seq[o.rule] = seq
+        domain, keyword = self._classify(o)
+        if domain:
+            self.domains.add(domain, seq)
+            self._where[seq] = ('domains', domain)
+        elif keyword:
+            with self.keyword_lock:
+                self.keywords[keyword].add(seq)
+                self._automaton = None
+                self.keyword_generation += 1
+            self._where[seq] = ('keywords', keyword)
+        else:
+            self.rest.add(seq)
+            self._where[seq] = ('rest', None)
+
+    @classmethod
+    def _classify(cls, o):
+        '''return (domain, keyword) a matching url is certain to have'''
+        rule = o.rule.rpartition('$')[0] if o.options else o.rule
+        if rule.startswith('@@'):
+            rule = rule[2:]
+        if rule.startswith('/') and rule.endswith('/'):
+            # a regex without special characters is a keyword
+            if re.search(r'[.^$*+?{}\[\]\\|()]', rule[1:-1]) or len(rule) - 2 <= cls.KEYLEN:
+                return None, None
+            return None, rule[1:-1]
+        if rule.startswith(('||', '|https://')):
+            suffix = ap_filter._glob_suffix(rule)
+            return (suffix.lower() if suffix else None), None
+        # "|" inside a rule is an alternation, "$" an anchor
+        if '$' in rule or '|' in rule[1:-1]:
+            return None, None
+        key = _literal(rule)
+        return None, (key if key and len(key) > cls.KEYLEN else None)
+
+    def remove(self, rule):
+        seq = self._seq.pop(rule, None)
+        if seq is None:
+            return None
+        bucket, key = self._where.pop(seq)
+        if bucket == 'domains':
+            self.domains.discard(key, seq)
+        elif bucket == 'keywords':
+            with self.keyword_lock:
+                self.keywords[key].discard(seq)
+                if not self.keywords[key]:
+                    del self.keywords[key]
+                self._automaton = None
+                self.keyword_generation += 1
+        else:
+            self.rest.discard(seq)
+        return self._entries.pop(seq)
+
+    def pop(self, index):
+        return self.remove(self[index][0].rule)
+
+    def match(self, url, host=None, shared=None):
+        '''return the first (ap_rule, value) matching url, None if no match'''
+        for o, value in self.candidates(url, host, shared):
+            if o.match(url):
+                return o, value
+
+    def candidates(self, url, host=None, shared=None):
+        '''(ap_rule, value) which may match url, in the order added'''
+        if not self._entries:
+            return
+        candidates = set(self.rest)
+        if host is None:
+            host = _host_of(url)
+        if host and len(self.domains):
+            for seqs in self.domains.match_all(host.lower()):
+                candidates.update(seqs)
+        if self.keywords:
+            found = shared.search(url, self) if shared else None
+            if found is None:
+                if self._automaton is None:
+                    self._automaton = ac_automaton(list(self.keywords))
+                found = self._automaton.search(url)
+            for keyword in found:
+                seqs = self.keywords.get(keyword)
+                if seqs:
+                    candidates.update(seqs)
+        for seq in sorted(candidates):
+            # None if removed since, temporary rules expire from the timer thread
+            entry = self._entries.get(seq)
+            if entry is not None:
+                yield entry
+
+    def __contains__(self, rule):
+        return rule in self._seq
+
+    def __getitem__(self, index):
+        return list(self._entries.values())[index]
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class rule_engine(object):
+    '''ap_filters and rule_tables tagged by source.
+
+    keywords of all sources share one automaton, a url is walked once
+    however many sources it is matched against. a source changed since
+    the automaton was built searches its own keywords until the shared
+    one is rebuilt in the background.
+    '''
+    REBUILD_DELAY = 10
+
+    def __init__(self, sources=None):
+        self.sources = OrderedDict()
+        self._built = None  # (ac_automaton, {id(keyword holder): keyword_generation})
+        self._rebuild = None
+        for name, source in sources or []:
+            self.add_source(name, source)
+
+    def add_source(self, name, source):
+        self.sources[name] = source
+        self._built = None
+
+    def _holders(self):
+        for source in self.sources.values():
+            yield source
+            if isinstance(source, ap_filter):
+                for table in (source.important, source.optioned_excludes, source.optioned):
+                    yield table
+
+    def _build(self):
+        try:
+            keywords = set()
+            generations = {}
+            for holder in self._holders():
+                # a temp rule may be added meanwhile, copy keywords and generation together
+                with holder.keyword_lock:
+                    generations[id(holder)] = holder.keyword_generation
+                    keywords.update(list(holder.keywords))
+            self._built = (ac_automaton(list(keywords)), generations)
+        finally:
+            self._rebuild = None
+
+    def automaton(self, holder):
+        '''shared automaton if it has all keywords of holder, else None'''
+        if self._built is None:
+            self._build()
+        automaton, generations = self._built
+        if generations.get(id(holder)) == holder.keyword_generation:
+            return automaton
+        if self._rebuild is None:
+            self._rebuild = timer.call_later(self.REBUILD_DELAY, self._build)
+
+    def query(self, url, host=None, page=None):
+        return rule_query(self, url, host, page)
+
+    def verdicts(self, url, host=None, page=None):
+        '''result of every source for url'''
+        return self.query(url, host, page).verdicts()
+
+
+class rule_query(object):
+    '''a request matched against the sources of a rule_engine.
+
+    the host is worked out once, keyword walks and results are kept per url.
+    '''
+
+    def __init__(self, engine, url, host=None, page=None):
+        self.engine = engine
+        self.url = url
+        self.host = host or _host_of(url)
+        self.page = page
+        self._found = {}  # url: keywords found
+        self._results = {}
+
+    def search(self, url, holder):
+        '''keywords found in url, None if holder has to search by itself'''
+        automaton = self.engine.automaton(holder)
+        if automaton is None:
+            return None
+        found = self._found.get(url)
+        if found is None:
+            found = self._found[url] = automaton.search(url)
+        return found
+
+    def match(self, name, url=None, domain_only=False):
+        '''result of source name, same as its own match()'''
+        url = url or self.url
+        key = (name, url, domain_only)
+        if key not in self._results:
+            source = self.engine.sources[name]
+            if isinstance(source, rule_table):
+                self._results[key] = source.match(url, self.host, shared=self)
+            else:
+                self._results[key] = source.match(url, self.host, domain_only, self.page, shared=self)
+        return self._results[key]
+
+    def verdicts(self):
+        return dict((name, self.match(name)) for name in self.engine.sources)
 
 
 if __name__ == "__main__":
@@ -258,6 +1134,10 @@ if __name__ == "__main__":
                 pass
         del data
     print('loading: %fs' % (time.clock() - t))
+    gfwlist.dump('gfwlist.snapshot.test', 'test')
+    t = time.clock()
+    ap_filter().load('gfwlist.snapshot.test', 'test')
+    print('loading from snapshot: %fs' % (time.clock() - t))
     print('result for inxian: %r' % gfwlist.match('http://www.inxian.com', 'www.inxian.com'))
     print('result for twitter: %r' % gfwlist.match('twitter.com:443', 'twitter.com'))
     print('result for 163: %r' % gfwlist.match('http://www.163.com', 'www.163.com'))
@@ -272,14 +1152,24 @@ if __name__ == "__main__":
     host = urlparse.urlparse(url).hostname
     print('%s, %s' % (url, host))
     print(gfwlist.match(url, host))
-    t = time.clock()
-    for _ in range(10000):
-        gfwlist.match(url, host)
     print('KEYLEN = %d' % gfwlist.KEYLEN)
-    print('10000 query for %s, %fs' % (url, time.clock() - t))
-    print('O(1): %d' % (len(gfwlist.rules) - (len(gfwlist.excludes) + len(gfwlist.slow) + len(gfwlist.url_startswith))))
-    print('O(n): %d' % (len(gfwlist.excludes) + len(gfwlist.slow) + len(gfwlist.url_startswith)))
+    for engine in ('window', 'ac'):
+        uncached = ap_filter(engine=engine, cache_size=0)
+        uncached.load('gfwlist.snapshot.test', 'test')
+        t = time.clock()
+        for _ in range(10000):
+            uncached.match(url, host)
+        print('10000 query for %s, engine %s, %fs' % (url, engine, time.clock() - t))
+    os.remove('gfwlist.snapshot.test')
+    print('O(1): %d' % (len(gfwlist.rules) - gfwlist.index_info()['regex']))
+    print('O(n): %d' % gfwlist.index_info()['regex'])
+    print('index: %r' % gfwlist.index_info())
     print('total: %d' % len(gfwlist.rules))
+    print('cache: %r' % gfwlist.cache_info())
+    print('memory: %r' % gfwlist.memory_info())
+    for o in gfwlist._ap_rules():
+        o._regex
+    print('memory, all compiled: %r' % gfwlist.memory_info())
     l = gfwlist.fast.keys()
     l = sorted(l, key=lambda x: len(gfwlist.fast[x]))
     for i in l[-10:]:
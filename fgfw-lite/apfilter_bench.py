@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#
+# offline benchmark for ap_filter: builds a synthetic rule list, replays a
+# url / host workload against every engine, reports load time, per-match
+# latency, throughput and memory.
+#
+#   python apfilter_bench.py -n 20000 --mix domain=50,keyword=25,prefix=10,glob=5,regex=2,exclude=8
+#   python apfilter_bench.py --rules gfwlist.txt
+#   python apfilter_bench.py -n 2000 --stress 10
+
+from __future__ import print_function, division
+
+import sys
+import gc
+import base64
+import random
+import argparse
+import threading
+from timeit import default_timer as clock
+
+from apfilter import ap_filter
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+DEFAULT_MIX = 'domain=50,keyword=25,prefix=10,glob=5,regex=2,exclude=8'
+TLDS = ['com', 'net', 'org', 'io', 'co.uk', 'com.tw', 'com.hk', 'jp', 'de', 'info']
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+class corpus(object):
+    '''random but reproducible rule list and workload'''
+
+    def __init__(self, seed=0, words=5000):
+        self.random = random.Random(seed)
+        self.words = [self.word() for _ in range(words)]
+        self.hosts = []
+        self.prefixes = []  # (url prefix, host) of "prefix" rules
+
+    def word(self, lo=3, hi=10):
+        return ''.join(self.random.choice(LETTERS) for _ in range(self.random.randint(lo, hi)))
+
+    def domain(self):
+        return '%s.%s' % (self.random.choice(self.words), self.random.choice(TLDS))
+
+    def path(self):
+        return '/'.join(self.random.choice(self.words) for _ in range(self.random.randint(1, 4)))
+
+    def rule(self, kind):
+        r = self.random
+        if kind == 'domain':
+            host = self.domain()
+            self.hosts.append(host)
+            return '||' + host
+        if kind == 'keyword':
+            return '%s%s' % (r.choice(self.words), r.choice(['-', '_', '.', '/'])) + r.choice(self.words)
+        if kind == 'prefix':
+            # plain "|http://" rules, without "*" or "^", go to the url_startswith index
+            host = self.domain()
+            self.hosts.append(host)
+            prefix = 'http://%s/%s' % (host, self.path())
+            self.prefixes.append((prefix, host))
+            return '|' + prefix
+        if kind == 'glob':
+            host = self.domain()
+            self.hosts.append('%s%d.%s' % (r.choice(self.words), r.randint(0, 9), host))
+            return '||%s*.%s' % (r.choice(self.words), host)
+        if kind == 'regex':
+            return r'/^https?:\/\/[^\/]+%s\.(com|net|org)/' % r.choice(self.words)
+        if kind == 'exclude':
+            host = self.domain()
+            self.hosts.append(host)
+            if r.random() < 0.5:
+                return '@@||' + host
+            return '@@|http://%s/%s' % (host, self.path())
+        raise ValueError('unknown rule kind: %s' % kind)
+
+    def rules(self, count, mix):
+        kinds = []
+        total = sum(mix.values())
+        for kind, weight in sorted(mix.items()):
+            kinds.extend([kind] * int(round(count * weight / total)))
+        self.random.shuffle(kinds)
+        return [self.rule(kind) for kind in kinds]
+
+    def workload(self, count, hit_ratio=0.3, connect_ratio=0.4):
+        '''(url, host) pairs, hosts drawn with a long tail like real browsing'''
+        r = self.random
+        pool = [self.domain() for _ in range(max(len(self.hosts), 1000))]
+        result = []
+        for _ in range(count):
+            if self.prefixes and r.random() < hit_ratio * len(self.prefixes) / len(self.hosts):
+                prefix, host = r.choice(self.prefixes)
+                result.append(('%s/%s' % (prefix, self.word()), host))
+                continue
+            if self.hosts and r.random() < hit_ratio:
+                host = r.choice(self.hosts)
+            else:
+                host = pool[min(int(r.paretovariate(1.2)) - 1, len(pool) - 1)]
+            if r.random() < 0.3:
+                host = '%s.%s' % (r.choice(['www', 'm', 'img', 'api', 'cdn']), host)
+            if r.random() < connect_ratio:
+                result.append(('%s:443' % host, host))
+            else:
+                result.append(('http://%s/%s' % (host, self.path()), host))
+        return result
+
+    def temporary_rules(self, count):
+        '''rules like those added with an expire time, and (url, host) pairs they match'''
+        r = self.random
+        rules, workload = [], []
+        for _ in range(count):
+            host = self.domain()
+            word = r.choice(self.words)
+            rules.extend(['|https://%s' % host, '||%s' % host, '||img*.%s' % host, '/%s[0-9]x/' % word,
+                          '|http://%s/%s' % (host, word), '||%s^$script' % host])
+            workload.extend([('%s:443' % host, host),
+                             ('http://%s/%s/%s' % (host, word, self.path()), host),
+                             ('http://img%d.%s/%s' % (r.randint(0, 9), host, self.path()), 'img.' + host),
+                             ('http://%s/%s%dx' % (self.domain(), word, r.randint(0, 9)), None)])
+        return rules, workload
+
+
+def stress(f, rules, workload, seconds, readers=4):
+    '''add and remove rules in two threads, like requests and expire timers do,
+    while readers match workload. return errors raised'''
+    errors = []
+    stop = clock() + seconds
+
+    def change(func, seed):
+        r = random.Random(seed)
+        while clock() < stop:
+            try:
+                func(r.choice(rules))
+            except Exception as e:
+                errors.append(e)
+
+    def read():
+        while clock() < stop:
+            for url, host in workload:
+                try:
+                    f.match(url, host)
+                except Exception as e:
+                    errors.append(e)
+
+    threads = [threading.Thread(target=change, args=(f.add, 1)),
+               threading.Thread(target=change, args=(f.remove, 2))]
+    threads.extend(threading.Thread(target=read) for _ in range(readers))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return errors
+
+
+def percentile(sorted_lst, q):
+    return sorted_lst[int(q * (len(sorted_lst) - 1))]
+
+
+def parse_mix(s):
+    mix = {}
+    for item in s.split(','):
+        kind, _, weight = item.partition('=')
+        mix[kind.strip()] = float(weight)
+    return mix
+
+
+def load(rules, engine, cache_size):
+    gc.collect()
+    if tracemalloc:
+        tracemalloc.start()
+    t = clock()
+    f = ap_filter(engine=engine, cache_size=cache_size)
+    for rule in rules:
+        try:
+            f.add(rule)
+        except Exception:
+            pass
+    load_time = clock() - t
+    traced = None
+    if tracemalloc:
+        traced = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+    return f, load_time, traced
+
+
+def run(f, workload):
+    timings = []
+    t0 = clock()
+    for url, host in workload:
+        t = clock()
+        f.match(url, host)
+        timings.append(clock() - t)
+    total = clock() - t0
+    timings.sort()
+    return {'p50': percentile(timings, 0.5),
+            'p99': percentile(timings, 0.99),
+            'qps': len(workload) / total if total else 0}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='offline ap_filter benchmark')
+    parser.add_argument('-n', '--count', type=int, default=20000, help='synthetic rules to generate')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='rule kinds and weights, default: %s' % DEFAULT_MIX)
+    parser.add_argument('-q', '--queries', type=int, default=20000, help='queries to replay')
+    parser.add_argument('--hit-ratio', type=float, default=0.3, help='share of queries for hosts the rules name')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--rules', help='load this abp rule file instead of generating rules')
+    parser.add_argument('--cache', type=int, default=0, help='ap_filter result cache size, 0 to measure the engine alone')
+    parser.add_argument('--engines', default='ac,window')
+    parser.add_argument('--stress', type=float, default=0, metavar='SECONDS',
+                        help='add and remove temporary rules from other threads while matching, instead of timing')
+    args = parser.parse_args(argv)
+
+    c = corpus(args.seed)
+    if args.rules:
+        with open(args.rules) as f:
+            data = f.read()
+        if '!' not in data:
+            data = base64.b64decode(''.join(data.split())).decode()
+        rules = data.splitlines()
+        c.hosts = [r.lstrip('|@').rstrip('/^') for r in rules if r.startswith(('||', '@@||')) and '*' not in r]
+    else:
+        rules = c.rules(args.count, parse_mix(args.mix))
+    workload = c.workload(args.queries, args.hit_ratio)
+
+    if args.stress:
+        temporary, workload = c.temporary_rules(50)
+        failed = 0
+        for engine in args.engines.split(','):
+            f = load(rules, engine, args.cache)[0]
+            errors = stress(f, temporary, workload, args.stress)
+            failed += len(errors)
+            print('engine %s: %d errors in %.1fs' % (engine, len(errors), args.stress))
+            for e in errors[:5]:
+                print('  %r' % e)
+        return 1 if failed else 0
+
+    print('%d rules, %d queries, cache %d' % (len(rules), len(workload), args.cache))
+    for engine in args.engines.split(','):
+        f, load_time, traced = load(rules, engine, args.cache)
+        result = run(f, workload)
+        memory = f.memory_info()
+        print('engine %s:' % engine)
+        print('  load        %.3fs' % load_time)
+        print('  match p50   %.1fus' % (result['p50'] * 1e6))
+        print('  match p99   %.1fus' % (result['p99'] * 1e6))
+        print('  throughput  %d match/s' % result['qps'])
+        print('  ap_rules    %d bytes/rule, %d of %d compiled' % (memory['bytes_per_rule'], memory['compiled'], memory['ap_rules']))
+        if traced is not None:
+            print('  traced      %d bytes/rule' % (traced // max(len(f.rules), 1)))
+        print('  index       %r' % f.index_info())
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
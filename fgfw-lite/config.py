@@ -7,7 +7,7 @@ import shutil
 import logging
 import logging.handlers
 import traceback
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 
 try:
     from ipaddr import IPv4Address
@@ -15,11 +15,15 @@ try:
 except ImportError:
     from ipaddress import IPv4Address, ip_address
 
-from parent_proxy import ParentProxyList, ParentProxy
+from apfilter import ap_filter
+from parent_proxy import ParentProxyList, ParentProxy, parent_selector
 from get_proxy import get_proxy
 from redirector import redirector
+from prober import parent_prober
+from connection import hedge_budget
 from util import SConfigParser, parse_hostport
 import resolver
+import ip_region
 
 if not os.path.isfile('./userconf.ini'):
     shutil.copyfile('./userconf.sample.ini', './userconf.ini')
@@ -127,6 +131,9 @@ function FindProxyForURL(url, host) {
 
 '''
 
+# options read while serving requests, see Config.reload()
+settings = namedtuple('settings', ['gfwlist', 'remoteapi', 'profile', 'autoupdate', 'race'])
+
 
 class Config(object):
     def __init__(self):
@@ -140,10 +147,12 @@ class Config(object):
 
         self.version = SConfigParser()
         self.userconf = SConfigParser()
+        self.generation = 0  # bumped whenever userconf may have changed
         self.reload()
         self.UPDATE_INTV = 6
         self.timeout = self.userconf.dgetint('fgfwproxy', 'timeout', 3)
         ParentProxy.DEFAULT_TIMEOUT = self.timeout
+        ParentProxy.selector = parent_selector(self.userconf.dget('fgfwproxy', 'selector', 'priority'))
         self.parentlist = ParentProxyList()
         self.HOSTS = defaultdict(list)
         self.GUI = '-GUI' in sys.argv
@@ -183,7 +192,13 @@ class Config(object):
             self.logger.addHandler(hdlr)
 
         self.region = set(x.upper() for x in self.userconf.dget('fgfwproxy', 'region', '').split('|') if x.strip())
-        self.profile_num = len(self.userconf.dget('fgfwproxy', 'profile', '13'))
+        self.region_table = None
+        if self.region:
+            try:
+                self.region_table = ip_region.build(self.region, cidr_file=self.userconf.dget('fgfwproxy', 'regionlist', '') or None)
+            except Exception as e:
+                self.logger.warning('building region table failed, using geoip lookups: %r' % e)
+        self.profile_num = len(self.settings.profile)
         self.xheaders = self.userconf.dgetbool('fgfwproxy', 'xheaders', False)
 
         if self.userconf.dget('fgfwproxy', 'parentproxy', ''):
@@ -205,6 +220,16 @@ class Config(object):
             self.logger.warning('No parent proxy available!')
 
         self.maxretry = self.userconf.dgetint('fgfwproxy', 'maxretry', 4)
+        hedge_budget.RATIO = self.userconf.dgetfloat('fgfwproxy', 'hedge', 0.05)
+        try:
+            self.PROBER = parent_prober(self.parentlist,
+                                        self.userconf.dget('fgfwproxy', 'probe_url', 'http://www.google.com/generate_204'),
+                                        self.userconf.dgetint('fgfwproxy', 'probe_interval', 300),
+                                        self.userconf.dgetint('fgfwproxy', 'probe_concurrency', 2))
+        except ValueError as e:
+            self.logger.warning('parent probing disabled: %s' % e)
+            self.PROBER = None
+        ap_filter.CACHE_SIZE = self.userconf.dgetint('fgfwproxy', 'rulecache', 1024)
 
         def addhost(host, ip):
             try:
@@ -263,12 +288,24 @@ class Config(object):
     def reload(self):
         self.version.read('version.ini')
         self.userconf.read('userconf.ini')
+        self.settings = self._settings()
+        self.generation += 1
 
     def confsave(self):
         with open('version.ini', 'w') as f:
             self.version.write(f)
         with open('userconf.ini', 'w') as f:
             self.userconf.write(f)
+        self.settings = self._settings()
+        self.generation += 1
+
+    def _settings(self):
+        '''parsed once here, swapped in whole so readers never see half an update'''
+        return settings(gfwlist=self.userconf.dgetbool('fgfwproxy', 'gfwlist', True),
+                        remoteapi=self.userconf.dgetbool('fgfwproxy', 'remoteapi', False),
+                        profile=self.userconf.dget('fgfwproxy', 'profile', '13'),
+                        autoupdate=self.userconf.dgetbool('FGFW_Lite', 'autoupdate', True),
+                        race=self.userconf.dgetbool('fgfwproxy', 'race', True))
 
     def addparentproxy(self, name, proxy):
         self.parentlist.addstr(name, proxy)
@@ -5,6 +5,12 @@ import base64
 import struct
 import logging
 import random
+from threading import Thread, RLock
+from timeit import default_timer
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
 
 from parent_proxy import ParentProxy
 from httputil import read_response_line, read_header_data
@@ -86,7 +92,7 @@ def create_connection(netloc, ctimeout=None, source_address=None, iplist=None, p
     if parentproxy and not isinstance(parentproxy, ParentProxy):
         logger.warning('parentproxy is not a ParentProxy instance, please check. %s' % (parentproxy))
         parentproxy = ParentProxy(parentproxy, parentproxy)
-    ctimeout = ctimeout or parentproxy.timeout
+    ctimeout = ctimeout or parentproxy.connect_timeout(netloc[0]) or parentproxy.timeout
     via = parentproxy.get_via() if parentproxy else None
     s = None
     if not parentproxy or not parentproxy.proxy:
@@ -139,3 +145,124 @@ def create_connection(netloc, ctimeout=None, source_address=None, iplist=None, p
     if s:
         return s
     raise IOError(0, 'create_connection failed!')
+
+
+class hedge_budget(object):
+    '''token bucket for hedged connects: every connect earns RATIO of a token,
+    starting a hedge takes a whole one. counts hedges and hedges that won.'''
+    RATIO = 0.05
+    BURST = 2
+
+    def __init__(self):
+        self.lock = RLock()
+        self.tokens = 0
+        self.connects = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def connect(self):
+        with self.lock:
+            self.connects += 1
+            self.tokens = min(self.tokens + self.RATIO, self.BURST)
+
+    def ready(self):
+        return self.tokens >= 1
+
+    def take(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.hedges += 1
+            return True
+
+    def won(self):
+        with self.lock:
+            self.wins += 1
+
+    def info(self):
+        return {'connects': self.connects,
+                'hedges': self.hedges,
+                'wins': self.wins,
+                'hedge_rate': round(self.hedges / float(self.connects), 4) if self.connects else 0,
+                'win_rate': round(self.wins / float(self.hedges), 4) if self.hedges else 0,
+                }
+
+
+hedger = hedge_budget()
+
+
+def race_connection(netloc, parents, delays, ctimeout=None, iplist=None, tunnel=False, hedge=None, failed=None):
+    '''connect through every parent in parents, parents[i] starting delays[i] seconds
+    after the first, or at once when all earlier attempts have failed.
+
+    ctimeout is one timeout for all parents, or a list with one per parent.
+    with a hedge_budget, a start that is due while an attempt is still
+    running needs a token from it, without one the running attempts are
+    waited for. parents that failed are appended to failed.
+
+    return (socket, parent) of the first to connect, the others are closed
+    as soon as they connect. raise the last error if all of them fail.
+    '''
+    results = Queue()
+    lock = RLock()
+    done = []
+    hedged = set()
+    timeouts = ctimeout if isinstance(ctimeout, list) else [ctimeout] * len(parents)
+
+    def attempt(parent, timeout):
+        t = default_timer()
+        try:
+            soc = create_connection(netloc, timeout, iplist=iplist, parentproxy=parent, tunnel=tunnel)
+        except Exception as e:
+            parent.connect_failed(netloc[0])
+            results.put((parent, None, e))
+            return
+        parent.log_connect(netloc[0], default_timer() - t)
+        with lock:
+            if not done:
+                results.put((parent, soc, None))
+                return
+        soc.close()
+
+    start = default_timer()
+    started = pending = 0
+    err = None
+    while True:
+        wait = None
+        if started < len(parents):
+            wait = start + delays[started] - default_timer()
+            if not pending or (wait <= 0 and (hedge is None or hedge.take())):
+                if pending:
+                    hedged.add(started)
+                t = Thread(target=attempt, args=(parents[started], timeouts[started]))
+                t.daemon = True
+                t.start()
+                started += 1
+                pending += 1
+                continue
+            if wait <= 0:
+                wait = None
+        elif not pending:
+            raise err
+        try:
+            parent, soc, e = results.get(timeout=wait)
+        except Empty:
+            continue
+        pending -= 1
+        if soc is None:
+            err = e
+            if failed is not None:
+                failed.append(parent)
+            if started < len(parents):
+                start = default_timer() - delays[started]
+            continue
+        with lock:
+            done.append(parent)
+        while not results.empty():
+            other = results.get()[1]
+            if other:
+                other.close()
+        if hedge and parents.index(parent) in hedged:
+            hedge.won()
+        return soc, parent
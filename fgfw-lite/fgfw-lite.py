@@ -59,6 +59,7 @@ except ImportError:
     except ImportError:
         from io import BytesIO as StringIO
 from threading import Thread
+from timeit import default_timer
 
 sys.dont_write_bytecode = True
 WORKINGDIR = '/'.join(os.path.dirname(os.path.abspath(__file__).replace('\\', '/')).split('/')[:-1])
@@ -69,7 +70,7 @@ if sys.platform.startswith('win'):
 
 import config
 from util import parse_hostport, is_connection_dropped, extract_server_name
-from connection import create_connection
+from connection import create_connection, race_connection, hedger
 from encrypt import BufEmptyError, InvalidTag
 from resolver import TCP_Resolver
 from parent_proxy import ParentProxy
@@ -226,6 +227,8 @@ class ProxyHandler(HTTPRequestHandler):
     protocol_version = "HTTP/1.1"
     bufsize = 8192
     timeout = 60
+    RACE_HEAD_START = 0.5  # seconds, before direct connect times are known
+    RACE_HEAD_START_MIN = 0.1
 
     def __init__(self, request, client_address, server):
         self.ssrealip = None
@@ -247,6 +250,7 @@ class ProxyHandler(HTTPRequestHandler):
         self.wbuffer_size = 0
         self.shortpath = None
         self.failed_parents = []
+        self.raced = False  # direct raced a proxy, the result is reported with the response
         self.path = ''
         self.noxff = False
         self.count = 0
@@ -278,6 +282,9 @@ class ProxyHandler(HTTPRequestHandler):
             self.pproxy = None
             return 1
         self.pproxy = self._proxylist.pop(0)
+        # a half-open parent takes its trial when picked, skip it while another request has it
+        while self._proxylist and self.pproxy.proxy and not self.pproxy.breaker.available():
+            self.pproxy = self._proxylist.pop(0)
         self.ppname = self.pproxy.name
 
     def do_GET(self):
@@ -351,8 +358,8 @@ class ProxyHandler(HTTPRequestHandler):
                 return self.send_error(403)
 
         if str(self.rip) == self.connection.getsockname()[0]:
-            if self.requesthost[1] in range(self.conf.listen[1], self.conf.listen[1] + len(self.conf.userconf.dget('fgfwproxy', 'profile', '134'))):
-                if self.conf.userconf.dgetbool('fgfwproxy', 'remoteapi', False):
+            if self.requesthost[1] in range(self.conf.listen[1], self.conf.listen[1] + len(self.conf.settings.profile)):
+                if self.conf.settings.remoteapi:
                     return self.api(parse)
                 return self.send_error(403)
 
@@ -490,10 +497,12 @@ class ProxyHandler(HTTPRequestHandler):
                         if self.retryable:
                             self.rbuffer.append(data)
                         self.remotesoc.sendall(data)
-                # read response line
-                timelog = time.clock()
+                # read response line, a request that cannot be retried is not cut short
+                self.remotesoc.settimeout(self.fbtimeout if self.retryable else max(self.fbtimeout, self.rtimeout))
+                timelog = default_timer()
                 response_line, protocol_version, response_status, response_reason = read_response_line(remoterfile)
-                rtime = time.clock() - timelog
+                rtime = default_timer() - timelog
+                self.remotesoc.settimeout(self.rtimeout)
             # read response headers
             while response_status == 100:
                 hdata = read_header_data(remoterfile)
@@ -576,7 +585,7 @@ class ProxyHandler(HTTPRequestHandler):
                             fd.remove(self.remotesoc)
                             self.connection.shutdown(socket.SHUT_WR)
             self.wfile_write()
-            self.conf.GET_PROXY.notify(self.command, self.shortpath, self.requesthost, True if response_status < 400 else False, self.failed_parents, self.ppname, rtime)
+            self.conf.GET_PROXY.notify(self.command, self.shortpath, self.requesthost, True if response_status < 400 else False, self.failed_parents, self.ppname, rtime, raced=self.raced)
             self.pproxy.log(self.requesthost[0], rtime)
             if remote_close or is_connection_dropped([self.remotesoc]):
                 try:
@@ -600,7 +609,7 @@ class ProxyHandler(HTTPRequestHandler):
     def on_GET_Error(self, e):
         if self.ppname:
             self.logger.warning('{} {} via {} failed: {}'.format(self.command, self.shortpath, self.ppname, repr(e)))
-            self.pproxy.log(self.requesthost[0], 10)
+            self.pproxy.log(self.requesthost[0], 10, success=False)
             return self._do_GET(True)
         self.conf.GET_PROXY.notify(self.command, self.shortpath, self.requesthost, False, self.failed_parents, self.ppname)
         return self.send_error(504)
@@ -711,7 +720,7 @@ class ProxyHandler(HTTPRequestHandler):
         self.logger.debug('_do_CONNECT: %d' % self.connection_port)
         if retry:
             self.failed_parents.append(self.ppname)
-            self.pproxy.log(self.requesthost[0], 10)
+            self.pproxy.log(self.requesthost[0], 10, success=False)
         if self.remotesoc:
             self.remotesoc.close()
         if not self.retryable or self.getparent():
@@ -736,13 +745,13 @@ class ProxyHandler(HTTPRequestHandler):
             self.logger.debug('write rbuffer')
             self.remotesoc.sendall(b''.join(self.rbuffer))
             count = 1
-            timelog = time.clock()
+            timelog = default_timer()
         rtime = 0
         fds = [self.connection, self.remotesoc]
         while self.retryable:
             try:
                 reason = ''
-                (ins, _, _) = select.select(fds, [], [], self.conf.timeout * 2)
+                (ins, _, _) = select.select(fds, [], [], self.fbtimeout if count else self.conf.timeout * 2)
                 if not ins:
                     self.logger.debug('timeout, break, stage 0: %d' % self.connection_port)
                     reason = 'timeout'
@@ -760,7 +769,7 @@ class ProxyHandler(HTTPRequestHandler):
                     # Now remotesoc is connected, set read timeout
                     self.remotesoc.settimeout(self.rtimeout)
                     count += 1
-                    timelog = time.clock()
+                    timelog = default_timer()
                     if self.retryable:
                         self.rbuffer.append(data)
                 if self.remotesoc in ins:
@@ -772,7 +781,7 @@ class ProxyHandler(HTTPRequestHandler):
                         reason = 'remote closed'
                         fds.remove(self.remotesoc)
                         break
-                    rtime = time.clock() - timelog
+                    rtime = default_timer() - timelog
                     self._wfile_write(data)
             except NetWorkIOError as e:
                 self.logger.warning('do_CONNECT error: %r on %s %s, stage 0: %d' % (e, reason, count, self.connection_port))
@@ -788,7 +797,7 @@ class ProxyHandler(HTTPRequestHandler):
                 return
         # not retryable, clear rbuffer
         self.rbuffer = []
-        self.conf.GET_PROXY.notify(self.command, self.path, self.requesthost, True, self.failed_parents, self.ppname, rtime)
+        self.conf.GET_PROXY.notify(self.command, self.path, self.requesthost, True, self.failed_parents, self.ppname, rtime, raced=self.raced)
         self.pproxy.log(self.requesthost[0], rtime)
         self.logger.debug('%s response time %.3fs' % (self.requesthost[0], rtime))
         self.logger.debug('start forwarding... %d' % len(fds))
@@ -867,12 +876,14 @@ class ProxyHandler(HTTPRequestHandler):
         if self._proxylist:
             if self.ppname == 'direct':
                 self.rtimeout = self.conf.timeout
-                self.ctimeout = self.conf.timeout
             else:
                 self.rtimeout = min(2 ** len(self.failed_parents) + self.conf.timeout - 1, 10)
-                self.ctimeout = min(2 ** len(self.failed_parents) + self.conf.timeout - 1, 10)
+            # learned from this parent and host, doubled for every parent failed already
+            backoff = 2 ** len(self.failed_parents)
+            self.ctimeout = self.pproxy.connect_timeout(self.requesthost[0], backoff) or self.rtimeout
+            self.fbtimeout = self.pproxy.first_byte_timeout(self.requesthost[0], backoff) or self.rtimeout
         else:
-            self.ctimeout = self.rtimeout = 10
+            self.ctimeout = self.rtimeout = self.fbtimeout = 10
 
     def _http_connect_via_proxy(self, netloc, iplist):
         if not self.failed_parents:
@@ -886,7 +897,69 @@ class ProxyHandler(HTTPRequestHandler):
 
     def _connect_via_proxy(self, netloc, iplist=None, tunnel=False):
         self.on_conn_log()
-        return create_connection(netloc, ctimeout=self.ctimeout, iplist=iplist, parentproxy=self.pproxy, tunnel=tunnel)
+        rival = next((p for p in self._proxylist if p.proxy and p is not self.pproxy and p.breaker.state == p.breaker.CLOSED), None)
+        if rival and self.ppname == 'direct' and not self.failed_parents and\
+                self.conf.settings.race and self.conf.GET_PROXY.should_race(netloc[0]):
+            return self._race_direct(netloc, iplist, tunnel, rival)
+        if self.pproxy.proxy:
+            hedger.connect()
+            delay = self.pproxy.connect_time(netloc[0], 0.9)
+            # without a token no hedge can start, connect the plain way
+            if rival and delay and hedger.ready():
+                return self._race(netloc, iplist, tunnel, rival, delay, hedger)
+        t = default_timer()
+        try:
+            soc = create_connection(netloc, ctimeout=self.ctimeout, iplist=iplist, parentproxy=self.pproxy, tunnel=tunnel)
+        except Exception:
+            self.pproxy.connect_failed(netloc[0])
+            raise
+        self.pproxy.log_connect(netloc[0], default_timer() - t)
+        return soc
+
+    def _race(self, netloc, iplist, tunnel, rival, delay, hedge=None):
+        '''connect through self.pproxy, and through rival too if not connected after delay.
+
+        rival stays in self._proxylist unless it was started and failed, or won.
+        if it wins it becomes self.pproxy and the old one goes back to the
+        front of the list, unless it failed.
+        '''
+        failed = []
+        # the rival connects with what was learned about it, not self.pproxy
+        timeouts = [self.ctimeout, rival.connect_timeout(netloc[0], 2 ** len(self.failed_parents)) or rival.timeout]
+        try:
+            soc, winner = race_connection(netloc, [self.pproxy, rival], [0, delay], timeouts, iplist, tunnel, hedge=hedge, failed=failed)
+        finally:
+            if rival in failed:
+                self._proxylist.remove(rival)
+                self.failed_parents.append(rival.name)
+                rival.log(netloc[0], 10, success=False)
+        if winner is rival:
+            self._proxylist.remove(rival)
+            if self.pproxy in failed:
+                self.failed_parents.append(self.ppname)
+                self.pproxy.log(netloc[0], 10, success=False)
+            else:
+                self._proxylist.insert(0, self.pproxy)
+            self.logger.debug('{} {}: {} connected before {}'.format(self.command, self.shortpath or self.path, rival.name, self.ppname))
+            self.pproxy, self.ppname = rival, rival.name
+            # read and first byte timeouts of the winner, not of the parent set_timeout() was called for
+            self.set_timeout()
+        return soc
+
+    def _race_direct(self, netloc, iplist, tunnel, rival):
+        '''neither rules nor region decided: direct gets a head start, then the best proxy races it'''
+        direct = self.pproxy
+        head_start = direct.connect_time(netloc[0], 0.9) or self.RACE_HEAD_START
+        head_start = min(max(head_start, self.RACE_HEAD_START_MIN), self.ctimeout)
+        soc = self._race(netloc, iplist, tunnel, rival, head_start)
+        if self.pproxy is not direct:
+            self.logger.info('{} {} raced, {} was faster than direct'.format(self.command, self.shortpath or self.path, self.ppname))
+            if direct.name not in self.failed_parents:
+                self._proxylist.remove(direct)
+                self.failed_parents.append(direct.name)
+        # a connect is no verdict yet, direct is often reset after it. notify() learns from the response
+        self.raced = True
+        return soc
 
     def api(self, parse):
         '''
@@ -958,6 +1031,13 @@ class ProxyHandler(HTTPRequestHandler):
             self.conf.confsave()
             self.write(200, data, 'application/json')
             return self.conf.stdout()
+        elif parse.path == '/api/parent/stats' and self.command == 'GET':
+            host = urlparse.parse_qs(parse.query).get('host', [None])[0]
+            return self.write(200, json.dumps(self.conf.parentlist.stats(host)), 'application/json')
+        elif parse.path == '/api/probe' and self.command == 'GET':
+            return self.write(200, json.dumps(self.conf.PROBER.results if self.conf.PROBER else {}), 'application/json')
+        elif parse.path == '/api/hedge' and self.command == 'GET':
+            return self.write(200, json.dumps(hedger.info()), 'application/json')
         elif parse.path.startswith('/api/parent/') and self.command == 'DELETE':
             try:
                 self.conf.parentlist.remove(parse.path[12:])
@@ -969,14 +1049,14 @@ class ProxyHandler(HTTPRequestHandler):
             except Exception as e:
                 return self.send_error(404, repr(e))
         elif parse.path == '/api/gfwlist' and self.command == 'GET':
-            return self.write(200, json.dumps(self.conf.userconf.dgetbool('fgfwproxy', 'gfwlist', True)), 'application/json')
+            return self.write(200, json.dumps(self.conf.settings.gfwlist), 'application/json')
         elif parse.path == '/api/gfwlist' and self.command == 'POST':
             self.conf.userconf.set('fgfwproxy', 'gfwlist', '1' if json.loads(body) else '0')
             self.conf.confsave()
             self.write(200, data, 'application/json')
             return self.conf.stdout()
         elif parse.path == '/api/autoupdate' and self.command == 'GET':
-            return self.write(200, json.dumps(self.conf.userconf.dgetbool('FGFW_Lite', 'autoupdate', True)), 'application/json')
+            return self.write(200, json.dumps(self.conf.settings.autoupdate), 'application/json')
         elif parse.path == '/api/autoupdate' and self.command == 'POST':
             self.conf.userconf.set('FGFW_Lite', 'autoupdate', '1' if json.loads(body) else '0')
             self.conf.confsave()
@@ -1110,6 +1190,7 @@ def update(conf, logger, auto=False):
     if not conf.GUI:
         for item in subprocess_handler.ITEMS:
             item.restart()
+    conf.REDIRECTOR.reload_adblock()  # before GET_PROXY.config(), which puts it in the rule_engine
     conf.GET_PROXY.config()
     if count:
         logger.info('Update Completed, %d file Updated.' % count)
@@ -1169,6 +1250,7 @@ class subprocess_handler(object):
 def atexit_do():
     for item in subprocess_handler.ITEMS:
         item.stop()
+    config.conf.GET_PROXY.routes.flush()
 
 
 def main():
@@ -1207,6 +1289,9 @@ def main():
         t = Thread(target=server.serve_forever)
         t.start()
 
+    if conf.PROBER:
+        conf.PROBER.start()
+
     t = Thread(target=updater, args=(conf, ))
     t.daemon = True
     t.start()
@@ -1,12 +1,13 @@
 #!/usr/bin/env python
 # coding:utf-8
 import base64
-import random
+import hashlib
 import logging
 
-from repoze.lru import lru_cache
+from repoze.lru import lru_cache, ExpiringLRUCache
 
 from util import ip_to_country_code
+from route_memory import route_memory
 
 
 ASIA = ('AE', 'AF', 'AL', 'AZ', 'BD', 'BH', 'BN', 'BT', 'CN', 'CY', 'HK', 'ID',
@@ -35,16 +36,20 @@ class get_proxy(object):
                                   datefmt='%H:%M:%S')
     hdr.setFormatter(formatter)
     logger.addHandler(hdr)
+    DECISION_CACHE_SIZE = 1024
+    DECISION_TTL = 10  # seconds a routing decision is reused
 
     def __init__(self, conf):
         self.conf = conf
+        self.routes = route_memory('./fgfw-lite/routes.json')
         self.config()
 
     def config(self):
-        from apfilter import ap_filter
+        from apfilter import ap_filter, rule_engine
         self.gfwlist = ap_filter()
         self.local = ap_filter()
         self.ignore = ap_filter()  # used by rules like "||twimg.com auto"
+        self._decisions = ExpiringLRUCache(self.DECISION_CACHE_SIZE, default_timeout=self.DECISION_TTL)
 
         for line in open('./fgfw-lite/local.txt'):
             rule, _, dest = line.strip().partition(' ')
@@ -58,16 +63,34 @@ class get_proxy(object):
             try:
                 with open('./fgfw-lite/gfwlist.txt') as f:
                     data = f.read()
+                digest = hashlib.sha1(data if isinstance(data, bytes) else data.encode('utf-8')).hexdigest()
+                if self.gfwlist.load('./fgfw-lite/gfwlist.snapshot', digest):
+                    self.logger.info('gfwlist loaded from snapshot')
+                else:
                     if '!' not in data:
                         data = ''.join(data.split())
                         data = base64.b64decode(data).decode()
                     for line in data.splitlines():
                         self.add_rule(line)
+                    try:
+                        self.gfwlist.dump('./fgfw-lite/gfwlist.snapshot', digest)
+                    except Exception as e:
+                        self.logger.warning('saving gfwlist snapshot failed: %r' % e)
             except Exception:
                 self.logger.warning('./fgfw-lite/gfwlist.txt is corrupted!')
+            self.logger.info('gfwlist: %d rules, %d need regex matching' % (len(self.gfwlist.rules), self.gfwlist.index_info()['regex']))
+
+        # all lists matched in one pass, see ifgfwed() and redirector.redirect()
+        self.rules = rule_engine([('redirector', self.conf.REDIRECTOR.redirlst),
+                                  ('adblock', self.conf.REDIRECTOR.adblock),
+                                  ('bad302', self.conf.REDIRECTOR._bad302),
+                                  ('local', self.local),
+                                  ('ignore', self.ignore),
+                                  ('gfwlist', self.gfwlist),
+                                  ])
 
     def redirect(self, hdlr):
-        return self.conf.REDIRECTOR.redirect(hdlr)
+        return self.conf.REDIRECTOR.redirect(hdlr, self.rules)
 
     def add_redirect(self, rule, dest):
         return self.conf.REDIRECTOR.add_redirect(rule, dest, self)
@@ -90,6 +113,11 @@ class get_proxy(object):
     @lru_cache(256, timeout=120)
     def ifhost_in_region(self, host, ip):
         try:
+            if self.conf.region_table is not None:
+                if ip in self.conf.region_table:
+                    self.logger.info('%s in region' % host)
+                    return True
+                return False
             code = ip_to_country_code(ip)
             if code in self.conf.region:
                 self.logger.info('%s in %s' % (host, code))
@@ -120,16 +148,17 @@ class get_proxy(object):
         if level == 4:
             return True
 
-        a = self.local.match(uri, host)
+        rules = self.rules.query(uri, host)
+        a = rules.match('local')
         if a is not None:
             return a
 
-        if self.ignore.match(uri, host):
+        if rules.match('ignore'):
             return None
 
-        if self.conf.userconf.dgetbool('fgfwproxy', 'gfwlist', True) and\
+        if self.conf.settings.gfwlist and\
                 uri.startswith('http://') and\
-                self.gfwlist.match('http://%s/' % host, host):
+                rules.match('gfwlist', 'http://%s/' % host):
             return True
 
         if self.ifhost_in_region(host, str(ip)):
@@ -144,7 +173,7 @@ class get_proxy(object):
         if level == 3:
             return True
 
-        if self.conf.userconf.dgetbool('fgfwproxy', 'gfwlist', True) and self.gfwlist.match(uri, host):
+        if self.conf.settings.gfwlist and rules.match('gfwlist'):
             return True
 
     def get_proxy(self, uri, host, command, ip, level=1):
@@ -161,7 +190,23 @@ class get_proxy(object):
                    5 -- global:      proxy if not localhost
         '''
         host, port = host
+        # plain http requests are routed by url rules too
+        key = (host, port, command, level, ip, None if command == 'CONNECT' else uri)
+        generation = self._generation()
+        route = self.routes.get(host)
+        cached = self._decisions.get(key)
+        if cached is not None and cached[0] == generation and cached[1] == route:
+            return [self.conf.parentlist.get(name) for name in cached[2]]
+        parentlist = self._get_proxy(uri, host, port, command, ip, level, route)
+        self._decisions.put(key, (generation, route, [parent.name for parent in parentlist]))
+        return parentlist
 
+    def _generation(self):
+        '''changes whenever a cached routing decision may be outdated'''
+        return (self.local.generation, self.ignore.generation, self.gfwlist.generation,
+                self.conf.parentlist.generation, self.conf.generation)
+
+    def _get_proxy(self, uri, host, port, command, ip, level, route=None):
         ifgfwed = self.ifgfwed(uri, host, port, ip, level)
 
         if ifgfwed is False:
@@ -176,17 +221,25 @@ class get_proxy(object):
 
         location = ip_to_country_code(ip) or u'None'
 
-        def priority(parent):
-            return parent.priority(command, host, location)
-
         if len(parentlist) > 1:
-            random.shuffle(parentlist)
-            parentlist = sorted(parentlist, key=priority)
+            parentlist = self.conf.parentlist.order(parentlist, command, host, location)
+
+        if route and route[1]:
+            # the parent that served this host best goes first, unless its circuit is open
+            for i, parent in enumerate(parentlist):
+                if parent.name == route[1]:
+                    if parent.breaker.usable():
+                        parentlist.insert(0, parentlist.pop(i))
+                    break
 
         if ifgfwed:
             if not parentlist:
                 self.logger.warning('No parent proxy available, direct connection is used')
                 return [self.conf.parentlist.get('direct')]
+        elif route and route[0] == 'proxy' and parentlist:
+            # direct failed for this host before, keep it as the last resort
+            parentlist = parentlist[:self.conf.maxretry - 1]
+            parentlist.append(self.conf.parentlist.direct)
         else:
             parentlist.insert(0, self.conf.parentlist.direct)
 
@@ -197,10 +250,13 @@ class get_proxy(object):
             parentlist = parentlist[:self.conf.maxretry]
         return parentlist
 
-    def notify(self, command, url, requesthost, success, failed_parents, current_parent, time=0):
+    def notify(self, command, url, requesthost, success, failed_parents, current_parent, time=0, raced=False):
         self.logger.debug('notify: %s %s %s, failed_parents: %r, final: %s' % (command, url, 'Success' if success else 'Failed', failed_parents, current_parent or 'None'))
         failed_parents = [k for k in failed_parents if 'pooled' not in k]
         if success:
+            for name in failed_parents:
+                if name in self.conf.parentlist.dict:
+                    self.routes.failed(requesthost[0], name)
             if 'direct' in failed_parents:
                 if command == 'CONNECT':
                     rule = '|https://%s' % requesthost[0]
@@ -211,6 +267,17 @@ class get_proxy(object):
                     exp = pow(resp_time, 2.5) if resp_time > 1 else 1
                     self.add_temp(rule, min(exp, 60))
                     self.conf.stdout()
+                self.routes.learn(requesthost[0], 'proxy', current_parent if current_parent in self.conf.parentlist.dict else None)
+            elif current_parent == 'direct':
+                # a won race is news, so is direct working where it failed before
+                if raced or self.routes.get(requesthost[0]):
+                    self.routes.learn(requesthost[0], 'direct')
+            elif current_parent in self.conf.parentlist.dict:
+                self.routes.learn(requesthost[0], parent=current_parent)
+
+    def should_race(self, host):
+        route = self.routes.get(host)
+        return route is None or route[0] != 'direct'
 
     def add_temp(self, rule, exp=None, quiet=False):
         # add temp rule for &exp minutes
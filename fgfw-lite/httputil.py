@@ -5,8 +5,7 @@ import sys
 import io
 import itertools
 import logging
-import time
-from threading import RLock, Thread
+from threading import RLock
 from collections import defaultdict, deque
 try:
     from http.client import HTTPMessage
@@ -14,6 +13,7 @@ try:
 except ImportError:
     from httplib import HTTPMessage
 from util import is_connection_dropped
+from timer_wheel import timer
 
 
 def read_response_line(fp):
@@ -70,10 +70,7 @@ class httpconn_pool(object):
         self.timerwheel_iter = itertools.cycle(range(self.count))
         self.timerwheel_index = next(self.timerwheel_iter)
         self.lock = RLock()
-
-        t = Thread(target=self._purge)
-        t.daemon = True
-        t.start()
+        timer.call_every(self.intv, self._purge)
 
     def put(self, upstream_name, soc, ppname):
         with self.lock:
@@ -103,27 +100,25 @@ class httpconn_pool(object):
             pass
 
     def _purge(self):
-        while 1:
-            time.sleep(self.intv)
-            pcount = 0
-            with self.lock:
-                remove_lst = []
-                for soc in is_connection_dropped(self.socs.keys()):
-                    soc.close()
-                    remove_lst.append(soc)
-                    pcount += 1
-                for soc in remove_lst:
-                    self._remove(soc)
-                remove_lst = []
-                if pcount:
-                    self.logger.debug('%s closed for connection droped.' % pcount)
-
-                self.timerwheel_index = next(self.timerwheel_iter)
-                for soc in list(self.timerwheel[self.timerwheel_index]):
-                    soc.close()
-                    remove_lst.append(soc)
-                    pcount += 1
-                for soc in remove_lst:
-                    self._remove(soc)
+        pcount = 0
+        with self.lock:
+            remove_lst = []
+            for soc in is_connection_dropped(self.socs.keys()):
+                soc.close()
+                remove_lst.append(soc)
+                pcount += 1
+            for soc in remove_lst:
+                self._remove(soc)
+            remove_lst = []
             if pcount:
-                self.logger.debug('%d remotesoc purged, %d in connection pool.(%s)' % (pcount, len(self.socs), ', '.join([('%s' % k[0]) if isinstance(k, tuple) else k for k, v in self.POOL.items() if v])))
+                self.logger.debug('%s closed for connection droped.' % pcount)
+
+            self.timerwheel_index = next(self.timerwheel_iter)
+            for soc in list(self.timerwheel[self.timerwheel_index]):
+                soc.close()
+                remove_lst.append(soc)
+                pcount += 1
+            for soc in remove_lst:
+                self._remove(soc)
+        if pcount:
+            self.logger.debug('%d remotesoc purged, %d in connection pool.(%s)' % (pcount, len(self.socs), ', '.join([('%s' % k[0]) if isinstance(k, tuple) else k for k, v in self.POOL.items() if v])))
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#
+# region detection without a geoip lookup per request: the networks of the
+# configured countries are compiled into sorted integer ranges once, then
+# every lookup is a bisect.
+#
+# sources: GeoLite2-Country.mmdb (walked directly, geoip2 is not needed) or
+# a chnroute style list with one CIDR per line.
+
+from __future__ import print_function, division
+
+import os
+import sys
+import struct
+import marshal
+import logging
+from array import array
+from bisect import bisect_right
+
+try:
+    from ipaddress import ip_address, ip_network
+except ImportError:
+    from ipaddr import IPAddress as ip_address, IPNetwork as ip_network
+
+logger = logging.getLogger('ip_region')
+logger.setLevel(logging.INFO)
+hdr = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s %(name)s:%(levelname)s %(message)s',
+                              datefmt='%H:%M:%S')
+hdr.setFormatter(formatter)
+logger.addHandler(hdr)
+
+METADATA_MARKER = b'\xab\xcd\xefMaxMind.com'
+
+
+class mmdb_reader(object):
+    '''just enough of the MaxMind DB format to walk the search tree.'''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.buf = f.read()
+        start = self.buf.rfind(METADATA_MARKER)
+        if start < 0:
+            raise ValueError('%s is not a MaxMind DB file' % path)
+        self.metadata = self.decode(start + len(METADATA_MARKER), 0)[0]
+        self.node_count = self.metadata['node_count']
+        self.record_size = self.metadata['record_size']
+        self.ip_version = self.metadata['ip_version']
+        self.node_size = self.record_size // 4
+        self.data_start = self.node_count * self.node_size + 16
+        self._read_node = {24: self._read_24, 28: self._read_28, 32: self._read_32}[self.record_size]
+
+    def _read_24(self, offset):
+        a, b, c, d, e, f = bytearray(self.buf[offset:offset + 6])
+        return a << 16 | b << 8 | c, d << 16 | e << 8 | f
+
+    def _read_28(self, offset):
+        a, b, c, m, d, e, f = bytearray(self.buf[offset:offset + 7])
+        return (m & 0xf0) << 20 | a << 16 | b << 8 | c, (m & 0x0f) << 24 | d << 16 | e << 8 | f
+
+    def _read_32(self, offset):
+        return struct.unpack('>II', self.buf[offset:offset + 8])
+
+    def _uint(self, offset, size):
+        value = 0
+        for byte in bytearray(self.buf[offset:offset + size]):
+            value = value << 8 | byte
+        return value
+
+    def decode(self, offset, base):
+        '''decode the data field at offset, return (value, next offset)'''
+        ctrl = bytearray(self.buf[offset:offset + 1])[0]
+        offset += 1
+        type_ = ctrl >> 5
+        if type_ == 1:  # pointer
+            size = (ctrl >> 3) & 3
+            pointer = self._uint(offset, size + 1)
+            if size < 3:
+                pointer |= (ctrl & 7) << (8 * (size + 1))
+            pointer += (0, 2048, 526336, 0)[size]
+            return self.decode(base + pointer, base)[0], offset + size + 1
+        if type_ == 0:
+            type_ = 7 + bytearray(self.buf[offset:offset + 1])[0]
+            offset += 1
+        size = ctrl & 0x1f
+        if size >= 29:
+            extra = size - 28
+            size = (29, 285, 65821)[extra - 1] + self._uint(offset, extra)
+            offset += extra
+        if type_ == 2:
+            return self.buf[offset:offset + size].decode('utf-8'), offset + size
+        if type_ == 7:
+            result = {}
+            for _ in range(size):
+                key, offset = self.decode(offset, base)
+                result[key], offset = self.decode(offset, base)
+            return result, offset
+        if type_ == 11:
+            result = []
+            for _ in range(size):
+                value, offset = self.decode(offset, base)
+                result.append(value)
+            return result, offset
+        if type_ == 14:
+            return bool(size), offset
+        if type_ == 3:
+            return struct.unpack('>d', self.buf[offset:offset + 8])[0], offset + 8
+        if type_ == 15:
+            return struct.unpack('>f', self.buf[offset:offset + 4])[0], offset + 4
+        if type_ == 4:
+            return self.buf[offset:offset + size], offset + size
+        if type_ in (5, 6, 9, 10):
+            return self._uint(offset, size), offset + size
+        if type_ == 8:
+            value = self._uint(offset, size)
+            return value - (1 << 32) if value >= 1 << 31 else value, offset + size
+        raise ValueError('unsupported mmdb data type %d' % type_)
+
+    def record(self, value):
+        return self.decode(self.data_start + value - self.node_count - 16, self.data_start)[0]
+
+    def networks(self):
+        '''yield (version, first address, prefix length, record pointer) for every network'''
+        stack = [(0, 0, 0)]
+        while stack:
+            node, address, depth = stack.pop()
+            if node > self.node_count:
+                if self.ip_version == 4:
+                    yield 4, address << (32 - depth), depth, node
+                elif depth >= 96 and address >> (depth - 96) == 0:
+                    yield 4, (address << (128 - depth)) & 0xffffffff, depth - 96, node
+                else:
+                    yield 6, address << (128 - depth), depth, node
+                continue
+            if node == self.node_count:
+                continue
+            # ::ffff:0:0/96, 2001::/32 (teredo) and 2002::/16 (6to4) point back to the ipv4
+            # subtree, walked again below them: 2002:0102:0304::/48 is where 1.2.3.4 is, like geoip2 says
+            left, right = self._read_node(node * self.node_size)
+            stack.append((right, address << 1 | 1, depth + 1))
+            stack.append((left, address << 1, depth + 1))
+
+
+class region_table(object):
+    '''sorted, merged [start, end] address ranges for ipv4 and ipv6.'''
+    SNAPSHOT_VERSION = 2
+
+    def __init__(self):
+        self.ranges = {4: ([], []), 6: ([], [])}
+
+    @classmethod
+    def from_mmdb(cls, path, codes):
+        codes = set(codes)
+        reader = mmdb_reader(path)
+        cache = {}
+        table = cls()
+        for version, address, prefixlen, pointer in reader.networks():
+            if pointer not in cache:
+                country = reader.record(pointer).get('country') or {}
+                cache[pointer] = country.get('iso_code') in codes
+            if cache[pointer]:
+                table._add(version, address, prefixlen)
+        table._merge()
+        return table
+
+    @classmethod
+    def from_cidrs(cls, lines):
+        table = cls()
+        for line in lines:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            net = ip_network(u'%s' % line)
+            address = int(net.network_address if hasattr(net, 'network_address') else net.network)
+            table._add(net.version, address, net.prefixlen)
+            if net.version == 4:
+                # the 6to4 addresses of the network, as the mmdb has them
+                table._add(6, 0x2002 << 112 | address << 80, 16 + net.prefixlen)
+        table._merge()
+        return table
+
+    def _add(self, version, address, prefixlen):
+        bits = 32 if version == 4 else 128
+        starts, ends = self.ranges[version]
+        starts.append(address)
+        ends.append(address + (1 << (bits - prefixlen)) - 1)
+
+    def _merge(self):
+        for version, (starts, ends) in list(self.ranges.items()):
+            merged_starts, merged_ends = [], []
+            for start, end in sorted(zip(starts, ends)):
+                if merged_ends and start <= merged_ends[-1] + 1:
+                    merged_ends[-1] = max(merged_ends[-1], end)
+                else:
+                    merged_starts.append(start)
+                    merged_ends.append(end)
+            if version == 4:
+                merged_starts, merged_ends = array('L', merged_starts), array('L', merged_ends)
+            self.ranges[version] = (merged_starts, merged_ends)
+
+    def __contains__(self, ip):
+        if not hasattr(ip, 'version'):
+            ip = ip_address(u'%s' % ip)
+        starts, ends = self.ranges[ip.version]
+        i = bisect_right(starts, int(ip)) - 1
+        return i >= 0 and int(ip) <= ends[i]
+
+    def contains_many(self, ips):
+        '''membership for many addresses, without the per-call overhead of "in"'''
+        ranges = self.ranges
+        result = []
+        append = result.append
+        for ip in ips:
+            if not hasattr(ip, 'version'):
+                ip = ip_address(u'%s' % ip)
+            starts, ends = ranges[ip.version]
+            value = int(ip)
+            i = bisect_right(starts, value) - 1
+            append(i >= 0 and value <= ends[i])
+        return result
+
+    def __len__(self):
+        return sum(len(starts) for starts, _ in self.ranges.values())
+
+    def _snapshot_header(self, digest):
+        return (self.SNAPSHOT_VERSION, tuple(sys.version_info[:2]), digest)
+
+    def dump(self, path, digest):
+        data = dict((version, (list(starts), list(ends))) for version, (starts, ends) in self.ranges.items())
+        with open(path + '.tmp', 'wb') as f:
+            marshal.dump(self._snapshot_header(digest), f)
+            marshal.dump(data, f)
+        if os.path.exists(path):
+            os.remove(path)
+        os.rename(path + '.tmp', path)
+
+    def load(self, path, digest):
+        try:
+            with open(path, 'rb') as f:
+                if marshal.load(f) != self._snapshot_header(digest):
+                    return False
+                data = marshal.load(f)
+        except Exception:
+            return False
+        self.ranges = {4: (array('L', data[4][0]), array('L', data[4][1])), 6: data[6]}
+        return True
+
+
+def build(codes, mmdb='./fgfw-lite/GeoLite2-Country.mmdb', cidr_file=None, snapshot='./fgfw-lite/region.snapshot'):
+    '''region_table for the country codes, from the cidr file if given, else the mmdb'''
+    source = cidr_file or mmdb
+    stat = os.stat(source)
+    digest = (source, stat.st_size, int(stat.st_mtime), tuple(sorted(codes)))
+    table = region_table()
+    if table.load(snapshot, digest):
+        return table
+    logger.info('compiling region table from %s...' % source)
+    if cidr_file:
+        with open(cidr_file) as f:
+            table = region_table.from_cidrs(f)
+    else:
+        table = region_table.from_mmdb(mmdb, codes)
+    try:
+        table.dump(snapshot, digest)
+    except Exception as e:
+        logger.warning('saving region snapshot failed: %r' % e)
+    return table
+
+
+if __name__ == '__main__':
+    import time
+    t = time.time()
+    table = region_table.from_mmdb(sys.argv[1] if len(sys.argv) > 1 else 'GeoLite2-Country.mmdb', ['CN'])
+    print('%d ranges, built in %.2fs' % (len(table), time.time() - t))
+    print(table.contains_many(['114.114.114.114', '8.8.8.8', '240e::1', '2001:4860::8888']))
@@ -1,7 +1,14 @@
 #!/usr/bin/env python
 # coding:utf-8
 import time
+import math
+import random
 import logging
+from array import array
+from collections import OrderedDict, deque
+from threading import RLock
+
+from timer_wheel import timer
 try:
     import urllib.parse as urlparse
     urlquote = urlparse.quote
@@ -38,18 +45,275 @@ hdr.setFormatter(formatter)
 logger.addHandler(hdr)
 
 
-class default_0_dict(dict):
-    def __missing__(self, key):
-        return 0
+class host_resp_time(object):
+    __slots__ = ('avg', 'counts')
+
+    def __init__(self, buckets):
+        self.avg = 0
+        self.counts = array('f', [0]) * buckets
+
+
+class resp_time_store(object):
+    '''response times of one parent, by host.
+
+    at most MAX_HOSTS hosts are kept, least recently logged go first. each
+    host has an EWMA and a histogram with log spaced buckets, p50 and p95
+    are read from the histogram, host None reads the histogram of all hosts.
+    decay() is called by the timer, reading does not change anything.
+    '''
+    MAX_HOSTS = 256
+    BUCKETS = 24
+    BASE = 0.01  # upper bound of the first bucket, seconds
+    GAMMA = 1.4  # every bucket is GAMMA times wider than the one before
+    DECAY = 0.93
+    DECAY_INTERVAL = 360
+    MIN_SAMPLES = 0.1  # hosts with less weight left are forgotten by decay()
+
+    def __init__(self):
+        self.lock = RLock()
+        self.hosts = OrderedDict()
+        self.avg = 0
+        self.all = host_resp_time(self.BUCKETS)
+
+    def bucket(self, rtime):
+        if rtime <= self.BASE:
+            return 0
+        return min(int(math.ceil(math.log(rtime / self.BASE, self.GAMMA))), self.BUCKETS - 1)
+
+    def log(self, host, rtime):
+        with self.lock:
+            stat = self.hosts.pop(host, None) or host_resp_time(self.BUCKETS)
+            self.hosts[host] = stat
+            if len(self.hosts) > self.MAX_HOSTS:
+                self.hosts.popitem(last=False)
+            stat.avg = 0.87 * (stat.avg or self.avg) + (1 - 0.87) * rtime
+            stat.counts[self.bucket(rtime)] += 1
+            self.all.counts[self.bucket(rtime)] += 1
+            self.avg = 0.87 * self.avg + (1 - 0.87) * rtime
+
+    def get_avg(self, host=None):
+        stat = self.hosts.get(host) if host else None
+        return (stat.avg if stat else 0) or self.avg
+
+    def percentile(self, host, q):
+        stat = self.all if host is None else self.hosts.get(host)
+        if stat is None:
+            return None
+        counts = list(stat.counts)
+        target = q * sum(counts)
+        if not target:
+            return None
+        for i, count in enumerate(counts):
+            target -= count
+            if target <= 0:
+                return self.BASE * self.GAMMA ** i
+
+    def decay(self):
+        with self.lock:
+            self.avg *= self.DECAY
+            for stat in [self.all] + list(self.hosts.values()):
+                stat.avg *= self.DECAY
+                counts = stat.counts
+                for i in range(len(counts)):
+                    counts[i] *= self.DECAY
+            for host, stat in list(self.hosts.items()):
+                if sum(stat.counts) < self.MIN_SAMPLES:
+                    del self.hosts[host]
+
+    def info(self, host=None):
+        hosts = [host] if host else list(self.hosts)
+        return dict((h, {'avg': round(self.get_avg(h), 3),
+                         'p50': round(self.percentile(h, 0.5), 3),
+                         'p95': round(self.percentile(h, 0.95), 3),
+                         'samples': round(sum(self.hosts[h].counts), 2)})
+                    for h in hosts if h in self.hosts)
+
+    def __len__(self):
+        return len(self.hosts)
+
+
+def host_bucket(host):
+    '''hosts sharing a timeout estimate: the /24 of an ipv4 address, else the last two labels,
+    three for names like example.com.cn'''
+    if not host:
+        return None
+    labels = host.rstrip('.').split('.')
+    if len(labels) == 4 and all(label.isdigit() for label in labels):
+        return '.'.join(labels[:3])
+    if len(labels) > 2 and len(labels[-1]) == 2 and len(labels[-2]) <= 3:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+class rto_estimator(object):
+    '''retransmission timeout style estimate (Jacobson/Karels), by host bucket.
+
+    srtt and rttvar are smoothed with ALPHA and BETA, the timeout is
+    srtt + K * rttvar, kept within floor and cap. a failure doubles the
+    timeout of the bucket until the next sample. buckets without samples
+    use the estimate of all samples, a failure there starts the bucket
+    from that estimate.
+    '''
+    ALPHA = 0.125
+    BETA = 0.25
+    K = 4
+    MAX_BUCKETS = 256
+
+    def __init__(self, floor=1.0, cap=10.0):
+        self.floor = floor
+        self.cap = cap
+        self.lock = RLock()
+        self.buckets = OrderedDict()  # bucket -> [srtt, rttvar, backoff]
+        self.all = None
+
+    def _update(self, state, rtime):
+        if state is None:
+            return [rtime, rtime / 2, 1]
+        srtt, rttvar, _ = state
+        rttvar = (1 - self.BETA) * rttvar + self.BETA * abs(srtt - rtime)
+        srtt = (1 - self.ALPHA) * srtt + self.ALPHA * rtime
+        return [srtt, rttvar, 1]
+
+    def log(self, host, rtime):
+        bucket = host_bucket(host)
+        with self.lock:
+            self.all = self._update(self.all, rtime)
+            if bucket:
+                self.buckets[bucket] = self._update(self.buckets.pop(bucket, None), rtime)
+                if len(self.buckets) > self.MAX_BUCKETS:
+                    self.buckets.popitem(last=False)
+
+    def backoff(self, host):
+        bucket = host_bucket(host)
+        with self.lock:
+            state = self.buckets.get(bucket)
+            if state is None:
+                if not bucket or self.all is None:
+                    return
+                state = self.buckets[bucket] = list(self.all)
+                if len(self.buckets) > self.MAX_BUCKETS:
+                    self.buckets.popitem(last=False)
+            state[2] = min(state[2] * 2, 64)
+
+    def timeout(self, host=None, backoff=1):
+        '''seconds, None without samples'''
+        return self._timeout(self.buckets.get(host_bucket(host)) or self.all, backoff)
+
+    def _timeout(self, state, backoff=1):
+        if state is None:
+            return None
+        srtt, rttvar, _backoff = state
+        return min(max(srtt + self.K * rttvar, self.floor) * _backoff * backoff, self.cap)
+
+    def info(self, host=None):
+        buckets = [host_bucket(host)] if host else list(self.buckets)
+        with self.lock:
+            return dict((b, {'srtt': round(self.buckets[b][0], 3),
+                             'rttvar': round(self.buckets[b][1], 3),
+                             'timeout': round(self._timeout(self.buckets[b]), 3)})
+                        for b in buckets if b in self.buckets)
+
+
+class circuit_breaker(object):
+    '''keeps a failing parent out of the parent lists.
+
+    closed: normal. opens after FAILURES failures in a row, or when at least
+    ERROR_RATE of the last WINDOW requests failed.
+    open: skipped for open_time seconds, which doubles every time a trial
+    fails, up to MAX_OPEN_TIME.
+    half-open: one trial request at a time may use the parent, a success
+    closes the circuit, a failure opens it again.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+    FAILURES = 3
+    WINDOW = 20
+    MIN_REQUESTS = 10
+    ERROR_RATE = 0.5
+    OPEN_TIME = 30
+    MAX_OPEN_TIME = 600
+    TRIAL_TIMEOUT = 60  # a trial not reported back by then is given up
+
+    def __init__(self, name):
+        self.name = name
+        self.state = self.CLOSED
+        self.failures = 0
+        self.results = deque(maxlen=self.WINDOW)
+        self.open_time = self.OPEN_TIME
+        self.opened_at = 0
+        self.trial_at = 0
+        self.on_change = None
+        self.lock = RLock()
+
+    def record(self, success):
+        with self.lock:
+            if self.state == self.OPEN:
+                return  # started before the circuit opened, only the trial decides
+            self.results.append(success)
+            if success:
+                self.failures = 0
+                if self.state == self.HALF_OPEN:
+                    self.open_time = self.OPEN_TIME
+                    self.results.clear()
+                    self._set(self.CLOSED)
+                    logger.info('%s is back' % self.name)
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.open_time = min(self.open_time * 2, self.MAX_OPEN_TIME)
+                self._open()
+            elif self.state == self.CLOSED and (self.failures >= self.FAILURES or self.error_rate() >= self.ERROR_RATE):
+                self._open()
+
+    def error_rate(self):
+        if len(self.results) < self.MIN_REQUESTS:
+            return 0
+        return self.results.count(False) / float(len(self.results))
+
+    def usable(self):
+        '''could a request use this parent now, without taking the trial'''
+        if self.state == self.CLOSED:
+            return True
+        now = time.time()
+        if self.state == self.OPEN:
+            return now - self.opened_at >= self.open_time
+        return now - self.trial_at >= self.TRIAL_TIMEOUT
+
+    def available(self):
+        '''may a request use this parent now, in half-open state this takes the trial'''
+        if self.state == self.CLOSED:
+            return True
+        with self.lock:
+            now = time.time()
+            if self.state == self.OPEN:
+                if now - self.opened_at < self.open_time:
+                    return False
+                self._set(self.HALF_OPEN)
+            if now - self.trial_at < self.TRIAL_TIMEOUT:
+                return False
+            self.trial_at = now
+            return True
+
+    def _open(self):
+        self.opened_at = time.time()
+        self.trial_at = 0
+        self._set(self.OPEN)
+        logger.warning('%s is failing, skipped for %ds' % (self.name, self.open_time))
+
+    def _set(self, state):
+        if state != self.state:
+            self.state = state
+            if self.on_change:
+                self.on_change()
 
 
 class ParentProxy(object):
     via = None
+    selector = None
     DEFAULT_TIMEOUT = 8
-    avg_resp_time = 0
-    avg_resp_time_ts = 0
-    avg_resp_time_by_host = default_0_dict()
-    avg_resp_time_by_host_ts = default_0_dict()
+    CONNECT_RTO = (1.0, 10.0)  # floor and cap, seconds
+    FIRST_BYTE_RTO = (2.0, 20.0)  # servers need some time to answer too
 
     def __init__(self, name, proxy):
         '''
@@ -80,6 +344,11 @@ class ParentProxy(object):
         self.timeout = int(timeout)
         self.country_code = self.query.get('location', [''])[0] or None
         self.last_ckeck = 0
+        self.resp_times = resp_time_store()
+        self.connect_times = resp_time_store()
+        self.connect_rto = rto_estimator(*self.CONNECT_RTO)
+        self.first_byte_rto = rto_estimator(*self.FIRST_BYTE_RTO)
+        self.breaker = circuit_breaker(name)
         if self.parse.scheme.lower() == 'sni':
             self.httppriority = -1
             logger.warning('sni proxy is detectable by GFW, server ip can be blocked.')
@@ -94,22 +363,40 @@ class ParentProxy(object):
         logger.debug('proxy %s to %s expected response time: %.3f' % (self.name, host, score))
         return result
 
-    def log(self, host, rtime):
-        self.avg_resp_time = 0.87 * self.get_avg_resp_time() + (1 - 0.87) * rtime
-        self.avg_resp_time_by_host[host] = 0.87 * self.get_avg_resp_time(host) + (1 - 0.87) * rtime
-        self.avg_resp_time_ts = self.avg_resp_time_by_host_ts[host] = time.time()
-        logger.debug('%s to %s: %.3fs avg: %.3fs' % (self.name, host, rtime, self.avg_resp_time))
+    def log(self, host, rtime, success=True):
+        self.resp_times.log(host, rtime)
+        if success:
+            self.first_byte_rto.log(host, rtime)
+        else:
+            self.connect_rto.backoff(host)
+            self.first_byte_rto.backoff(host)
+        if self.selector:
+            self.selector.log(self, rtime, success)
+        logger.debug('%s to %s: %.3fs avg: %.3fs' % (self.name, host, rtime, self.resp_times.avg))
 
     def get_avg_resp_time(self, host=None):
-        if host is None:
-            if time.time() - self.avg_resp_time_ts > 360:
-                self.avg_resp_time *= 0.93
-                self.avg_resp_time_ts = time.time()
-            return self.avg_resp_time
-        if time.time() - self.avg_resp_time_by_host_ts[host] > 360:
-            self.avg_resp_time_by_host[host] *= 0.93
-            self.avg_resp_time_by_host_ts[host] = time.time()
-        return self.avg_resp_time_by_host[host] or self.avg_resp_time
+        return self.resp_times.get_avg(host)
+
+    def log_connect(self, host, ctime):
+        self.connect_times.log(host, ctime)
+        self.connect_rto.log(host, ctime)
+        if self.proxy:
+            self.breaker.record(True)
+
+    def connect_failed(self, host):
+        '''connect or tunnel setup failed, only these decide the circuit'''
+        if self.proxy:
+            self.breaker.record(False)
+
+    def connect_timeout(self, host=None, backoff=1):
+        return self.connect_rto.timeout(host, backoff)
+
+    def first_byte_timeout(self, host=None, backoff=1):
+        return self.first_byte_rto.timeout(host, backoff)
+
+    def connect_time(self, host=None, q=0.9):
+        '''q-quantile of connect time to host, or to all hosts if host is unknown, None without data'''
+        return self.connect_times.percentile(host, q) or self.connect_times.percentile(None, q)
 
     @property
     def scheme(self):
@@ -154,6 +441,8 @@ class ParentProxyList(object):
         self._httpparents = set()
         self._httpsparents = set()
         self.dict = {}
+        self.generation = 0  # bumped on add, remove and circuit state changes
+        timer.call_every(resp_time_store.DECAY_INTERVAL, self.decay)
 
     def addstr(self, name, proxy):
         self.add(ParentProxy(name, proxy))
@@ -166,12 +455,14 @@ class ParentProxyList(object):
         logger.info('add parent: %s: %s' % (parentproxy.name, s))
         assert isinstance(parentproxy, ParentProxy)
         self.dict[parentproxy.name] = parentproxy
+        self.generation += 1
         if parentproxy.name == 'direct':
             self.direct = parentproxy
             return
         if parentproxy.name == 'local':
             self.local = parentproxy
             return
+        parentproxy.breaker.on_change = self._changed
         if 0 <= parentproxy.httppriority <= 100:
             self._httpparents.add(parentproxy)
         if 0 <= parentproxy.httpspriority <= 100:
@@ -182,14 +473,196 @@ class ParentProxyList(object):
             return 1
         a = self.dict.get(name)
         del self.dict[name]
+        self.generation += 1
         self._httpparents.discard(a)
         self._httpsparents.discard(a)
 
+    def _changed(self):
+        self.generation += 1
+
+    def _available(self, parents):
+        '''parents with an open circuit are left out, unless all of them are'''
+        parents = list(parents)
+        return [p for p in parents if p.breaker.usable()] or parents
+
     def httpparents(self):
-        return list(self._httpparents)
+        return self._available(self._httpparents)
 
     def httpsparents(self):
-        return list(self._httpsparents)
+        return self._available(self._httpsparents)
 
     def get(self, key):
         return self.dict.get(key)
+
+    def decay(self):
+        for parent in list(self.dict.values()):
+            parent.resp_times.decay()
+            parent.connect_times.decay()
+
+    def stats(self, host=None):
+        '''what parent ordering is based on, for the api'''
+        selector = ParentProxy.selector.info() if ParentProxy.selector else {}
+        return dict((name, {'httppriority': parent.httppriority,
+                            'httpspriority': parent.httpspriority,
+                            'avg': round(parent.get_avg_resp_time(), 3),
+                            'circuit': parent.breaker.state,
+                            'selector': selector.get(name),
+                            'hosts': parent.resp_times.info(host),
+                            'connect': parent.connect_times.info(host),
+                            'rto': {'connect': parent.connect_rto.info(host),
+                                    'first_byte': parent.first_byte_rto.info(host)},
+                            }) for name, parent in list(self.dict.items()))
+
+    def order(self, parentlist, method, host, country_code):
+        '''sort parentlist, best first, with the selector set on ParentProxy'''
+        selector = ParentProxy.selector or priority_selector()
+        return selector.order(parentlist, method, host, country_code)
+
+
+class priority_selector(object):
+    '''static priority plus 5 times the average response time, ties broken at random'''
+    name = 'priority'
+
+    def log(self, parent, rtime, success):
+        pass
+
+    def order(self, parentlist, method, host, country_code):
+        parentlist = list(parentlist)
+        random.shuffle(parentlist)
+        return sorted(parentlist, key=lambda parent: parent.priority(method, host, country_code))
+
+    def info(self):
+        return {}
+
+
+class bandit_selector(object):
+    '''base of the learning selectors.
+
+    stats are kept per parent and discounted on every sample, so a parent
+    that got slow or came back is noticed. a failure costs FAILED seconds.
+    the score stays on the priority scale: static priority plus 5 times
+    the estimated response time, lower is better.
+
+    scores only change with a sample, so the ranking of all known parents
+    is rebuilt in log() and order() just picks from it.
+    '''
+    DISCOUNT = 0.995
+    FAILED = 10
+
+    def __init__(self):
+        self.lock = RLock()
+        self.stats = {}  # parent name -> [samples, total cost]
+        self.parents = {}  # parent name -> parent, every parent ranked
+        self.rank = {False: {}, True: {}}  # CONNECT? -> parent name -> position
+
+    def log(self, parent, rtime, success):
+        with self.lock:
+            for stat in self.stats.values():
+                stat[0] *= self.DISCOUNT
+                stat[1] *= self.DISCOUNT
+            stat = self.stats.setdefault(parent.name, [0.0, 0.0])
+            stat[0] += 1
+            stat[1] += min(rtime, self.FAILED) if success else self.FAILED
+            self.parents[parent.name] = parent
+            self.update()
+
+    def update(self):
+        estimates = dict((name, self.estimate(name)) for name in self.parents)
+        for connect in (False, True):
+            scores = dict((name, (parent.httpspriority if connect else parent.httppriority) + 5 * estimates[name])
+                          for name, parent in self.parents.items())
+            self.rank[connect] = dict((name, i) for i, name in enumerate(sorted(scores, key=scores.get)))
+
+    def order(self, parentlist, method, host, country_code):
+        rank = self.rank[method == 'CONNECT']
+        if any(parent.name not in rank for parent in parentlist):
+            with self.lock:  # not seen before, rank it once
+                for parent in parentlist:
+                    self.parents.setdefault(parent.name, parent)
+                self.update()
+            rank = self.rank[method == 'CONNECT']
+        return sorted(parentlist, key=lambda parent: rank[parent.name])
+
+    def info(self):
+        return dict((name, {'samples': round(n, 2), 'avg': round(cost / n, 3) if n else None, 'estimate': round(self.estimate(name), 3)})
+                    for name, (n, cost) in list(self.stats.items()))
+
+
+class ucb_selector(bandit_selector):
+    '''lower confidence bound on response time (UCB1 on cost).
+
+    parents with few samples get the benefit of the doubt, so one bad
+    sample does not bury a parent for good.
+    '''
+    name = 'ucb'
+    EXPLORE = 2.0
+
+    def __init__(self):
+        bandit_selector.__init__(self)
+        self.bounds = {}
+
+    def update(self):
+        total = sum(n for n, _ in self.stats.values())
+        bounds = {}
+        for name, (n, cost) in self.stats.items():
+            bonus = self.EXPLORE * math.sqrt(math.log(max(total, 1)) / n)
+            bounds[name] = max(cost / n - bonus, 0)
+        self.bounds = bounds
+        bandit_selector.update(self)
+
+    def estimate(self, name):
+        return self.bounds.get(name, 0)
+
+
+class thompson_selector(bandit_selector):
+    '''thompson sampling, a beta posterior over 1 / (1 + response time).
+
+    one draw per parent on every sample, the ranking holds until the next.
+    '''
+    name = 'thompson'
+
+    def __init__(self):
+        bandit_selector.__init__(self)
+        self.reward = {}  # parent name -> [alpha, beta]
+
+    def log(self, parent, rtime, success):
+        with self.lock:
+            for reward in self.reward.values():
+                reward[0] *= self.DISCOUNT
+                reward[1] *= self.DISCOUNT
+            reward = self.reward.setdefault(parent.name, [0.0, 0.0])
+            r = 1.0 / (1 + rtime) if success else 0
+            reward[0] += r
+            reward[1] += 1 - r
+            bandit_selector.log(self, parent, rtime, success)
+
+    def estimate(self, name):
+        alpha, beta = self.reward.get(name, (0, 0))
+        theta = random.betavariate(alpha + 1, beta + 1)
+        return min(1.0 / theta - 1, self.FAILED)
+
+
+SELECTORS = dict((cls.name, cls) for cls in (priority_selector, ucb_selector, thompson_selector))
+
+
+def parent_selector(name):
+    if name not in SELECTORS:
+        logger.warning('unknown parent selector %r, using priority' % name)
+        name = 'priority'
+    return SELECTORS[name]()
+
+
+if __name__ == '__main__':
+    rto = rto_estimator()
+    for _ in range(10):
+        rto.log('www.example.com', 0.1)
+    # a host never connected to backs off from the estimate of all hosts
+    timeouts = [rto.timeout('unseen.org')]
+    for _ in range(3):
+        rto.backoff('unseen.org')
+        timeouts.append(rto.timeout('unseen.org'))
+    print('timeout of unseen.org after 0..3 failures: %r' % timeouts)
+    assert timeouts == sorted(set(timeouts)), 'backoff does not grow the timeout'
+    assert rto.timeout('www.example.com') == timeouts[0]
+    rto.log('unseen.org', 0.1)
+    assert rto.timeout('unseen.org') == timeouts[0], 'a sample does not reset the backoff'
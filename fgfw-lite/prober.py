@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#
+# active health probing of parent proxies: every parent is asked for a
+# small http resource now and then, so a parent that died or came back is
+# noticed before a user request has to find out.
+#
+#   python prober.py                       probe a local stand-in target directly
+#   python prober.py http://127.0.0.1:8118 probe it through a running proxy
+
+from __future__ import print_function, division
+
+import time
+import random
+import logging
+import traceback
+from threading import Thread, BoundedSemaphore
+from timeit import default_timer
+try:
+    import urllib.parse as urlparse
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    import urlparse
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from parent_proxy import circuit_breaker
+from connection import create_connection, do_tunnel
+from httputil import read_response_line
+from timer_wheel import timer
+
+logger = logging.getLogger('prober')
+logger.setLevel(logging.INFO)
+hdr = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s %(name)s:%(levelname)s %(message)s',
+                              datefmt='%H:%M:%S')
+hdr.setFormatter(formatter)
+logger.addHandler(hdr)
+
+
+class parent_prober(object):
+    '''probe every parent about every interval seconds, at most concurrency at a time.
+
+    a probe measures connect (tcp to an http parent), handshake (tunnel or
+    proxy protocol setup) and ttfb (request sent to response line). like
+    for a user request, connect plus handshake is logged as the connect
+    time and decides the circuit, ttfb is logged as the response time. an
+    open circuit is only probed once it may take a trial.
+    '''
+    JITTER = 0.2  # probes are spread over the first 2 * JITTER of every interval
+    RETRY = 5  # seconds, when the concurrency budget is used up
+
+    def __init__(self, parentlist, url='http://www.google.com/generate_204', interval=300, concurrency=2):
+        self.parentlist = parentlist
+        parse = urlparse.urlparse(url)
+        if parse.scheme != 'http':
+            raise ValueError('probe url should be plain http: %s' % url)
+        self.netloc = (parse.hostname, parse.port or 80)
+        self.path = parse.path or '/'
+        self.interval = interval
+        self.budget = BoundedSemaphore(concurrency)
+        self.results = {}  # parent name -> result of the last probe
+        self._scheduled = set()
+
+    def start(self):
+        if self.interval > 0:
+            timer.call_every(self.interval, self._schedule_all)
+            self._schedule_all()
+
+    def _schedule_all(self):
+        for name, parent in list(self.parentlist.dict.items()):
+            if name in ('direct', 'local') or name in self._scheduled:
+                continue
+            self._scheduled.add(name)
+            timer.call_later(self.interval * random.uniform(0, self.JITTER * 2), self._launch, parent)
+
+    def _launch(self, parent):
+        if not self.budget.acquire(False):
+            timer.call_later(self.RETRY * random.uniform(1 - self.JITTER, 1 + self.JITTER), self._launch, parent)
+            return
+        t = Thread(target=self._run, args=(parent, ))
+        t.daemon = True
+        t.start()
+
+    def _run(self, parent):
+        try:
+            if self.parentlist.get(parent.name) is parent:
+                self.probe(parent)
+        except Exception:
+            logger.error('probe %s failed: %s' % (parent.name, traceback.format_exc()))
+        finally:
+            self._scheduled.discard(parent.name)
+            self.budget.release()
+
+    def probe(self, parent):
+        if parent.breaker.state != circuit_breaker.CLOSED and not parent.breaker.available():
+            return
+        result = {'time': time.time(), 'connect': None, 'handshake': None, 'ttfb': None, 'status': None, 'error': None}
+        soc = None
+        try:
+            t = default_timer()
+            if parent.proxy and parent.scheme == 'http':
+                soc = create_connection(self.netloc, parentproxy=parent, tunnel=False)
+                result['connect'] = default_timer() - t
+                t = default_timer()
+                do_tunnel(soc, self.netloc, parent)
+            else:
+                soc = create_connection(self.netloc, parentproxy=parent, tunnel=True)
+            result['handshake'] = default_timer() - t
+            soc.settimeout(parent.timeout * 2)
+            t = default_timer()
+            soc.sendall(('GET %s HTTP/1.1\r\nHost: %s\r\nConnection: close\r\n\r\n' % (self.path, self.netloc[0])).encode())
+            result['status'] = read_response_line(soc.makefile('rb', 0))[2]
+            result['ttfb'] = default_timer() - t
+        except Exception as e:
+            result['error'] = repr(e)
+        finally:
+            if soc:
+                soc.close()
+        if result['handshake'] is None:
+            parent.connect_failed(self.netloc[0])
+        else:
+            # what create_connection takes for a user request, feeds race, hedge and timeouts
+            parent.log_connect(self.netloc[0], (result['connect'] or 0) + result['handshake'])
+        ok = result['ttfb'] is not None
+        parent.log(self.netloc[0], result['ttfb'] if ok else 10, success=ok)
+        self.results[parent.name] = result
+        logger.debug('probe %s: %r' % (parent.name, result))
+        return result
+
+
+class _target_handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def stand_in_target(address=('127.0.0.1', 0)):
+    '''local http server answering 204, start probing against it without network access'''
+    server = HTTPServer(address, _target_handler)
+    t = Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+if __name__ == '__main__':
+    import sys
+    from parent_proxy import ParentProxyList
+    target = stand_in_target()
+    parentlist = ParentProxyList()
+    parentlist.addstr('direct', 'direct 0')
+    parentlist.addstr('probe', sys.argv[1] if len(sys.argv) > 1 else 'direct')
+    prober = parent_prober(parentlist, 'http://127.0.0.1:%d/generate_204' % target.server_address[1])
+    print(prober.probe(parentlist.get('probe')))
+    print(parentlist.stats()['probe'])
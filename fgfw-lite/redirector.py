@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 # coding: UTF-8
+import os
 import re
 import logging
 try:
@@ -8,6 +9,7 @@ try:
     urlunquote = urlparse.unquote
 except ImportError:
     import urllib2
+    import urlparse
     urlquote = urllib2.quote
     urlunquote = urllib2.unquote
 
@@ -20,7 +22,7 @@ except ImportError:
 
 class redirector(object):
     def __init__(self, conf):
-        from apfilter import ap_filter
+        from apfilter import ap_filter, rule_table
         self.conf = conf
         self.logger = logging.getLogger('redirector')
         self.logger.setLevel(logging.INFO)
@@ -31,9 +33,29 @@ class redirector(object):
         self.logger.addHandler(hdr)
         self._bad302 = ap_filter()
         self.adblock = ap_filter()
-        self.redirlst = []
+        self.redirlst = rule_table()
+        self.reload_adblock()
+
+    def reload_adblock(self):
+        '''(re)load adblock.txt, called again by the updater after downloading it'''
+        if self.conf.userconf.dget('fgfwproxy', 'adblock_url', '') and os.path.exists('./fgfw-lite/adblock.txt'):
+            self.load_adblock('./fgfw-lite/adblock.txt')
+
+    def load_adblock(self, path):
+        # filled aside and swapped in, requests keep the old list meanwhile
+        from apfilter import ap_filter
+        adblock = ap_filter()
+        with open(path) as f:
+            for line in f:
+                try:
+                    adblock.add(line)
+                except Exception as e:
+                    self.logger.debug('create adblock rule failed: %r' % e)
+        self.adblock = adblock
+        self.logger.info('adblock: %d rules loaded, %r' % (len(adblock.rules), adblock.index_info()))
 
-    def redirect(self, hdlr):
+    def redirect(self, hdlr, rules=None):
+        '''rules: rule_engine holding redirlst as "redirector" and adblock as "adblock"'''
         searchword = re.match(r'^http://([\w-]+)/$', hdlr.path)
         if searchword:
             q = searchword.group(1)
@@ -41,17 +63,22 @@ class redirector(object):
                 q = q.encode().decode('idna')
             self.logger.debug('Match redirect rule addressbar-search')
             return 'https://www.google.com/search?q=%s&ie=utf-8&oe=utf-8' % urlquote(q.encode('utf-8'))
-        for rule, result in self.redirlst:
-            if rule.match(hdlr.path):
-                self.logger.debug('Match redirect rule {}, {}'.format(rule.rule, result))
-                if rule.override:
-                    return None
-                if result == 'forcehttps':
-                    return hdlr.path.replace('http://', 'https://', 1)
-                if result.startswith('/') and result.endswith('/'):
-                    return rule._regex.sub(result[1:-1], hdlr.path)
-                return result
-        if self.adblock.match(hdlr.path):
+        referer = hdlr.headers.get('Referer')
+        page = urlparse.urlparse(referer).hostname if referer else None
+        query = rules.query(hdlr.path, page=page) if rules else None
+        match = query.match('redirector') if query else self.redirlst.match(hdlr.path)
+        if match:
+            rule, result = match
+            self.logger.debug('Match redirect rule {}, {}'.format(rule.rule, result))
+            if rule.override:
+                return None
+            if result == 'forcehttps':
+                return hdlr.path.replace('http://', 'https://', 1)
+            if result.startswith('/') and result.endswith('/'):
+                return rule._regex.sub(result[1:-1], hdlr.path)
+            return result
+        adblock = query.match('adblock') if query else self.adblock.match(hdlr.path, page=page)
+        if adblock:
             return 'adblock'
         return uredirector(hdlr)
 
@@ -63,7 +90,7 @@ class redirector(object):
         if pp is None:
             pp = self.conf.GET_PROXY
         try:
-            if rule in [a.rule for a, b in self.redirlst]:
+            if rule in self.redirlst:
                 self.logger.warning('multiple redirector rule! %s' % rule)
                 return
             if dest.lower() == 'auto':
@@ -72,6 +99,6 @@ class redirector(object):
                 return self._bad302.add(rule)
             if dest.lower() == 'adblock':
                 return self.adblock.add(rule)
-            self.redirlst.append((ap_rule(rule), dest))
+            self.redirlst.add(ap_rule(rule), dest)
         except ValueError as e:
             self.logger.debug('create autoproxy rule failed: %s' % e)
@@ -8,7 +8,7 @@ import traceback
 import logging
 import time
 import itertools
-from threading import Event, Thread
+from threading import Event
 
 try:
     from ipaddr import IPAddress as ip_address
@@ -16,6 +16,7 @@ except ImportError:
     from ipaddress import ip_address
 
 from connection import create_connection
+from timer_wheel import timer
 
 
 logger = logging.getLogger('resolver')
@@ -42,9 +43,7 @@ class DNS_Cache(object):
         next(self._flip_iter)
         self._bad_cache_iter = itertools.cycle(range(NUM_BAD_CACHE))
         self._bad_cache_id = next(self._bad_cache_iter)
-        t = Thread(target=self._sched_clean, args=(CLEAN_INTV, ))
-        t.daemon = True
-        t.start()
+        timer.call_every(CLEAN_INTV, self._clean)
 
     def cache(self, host, qtype, result):
         logger.debug('dns cache add: {} {!r} {}'.format(host, qtype, result.__class__.__name__))
@@ -68,14 +67,12 @@ class DNS_Cache(object):
         self._cache = [{} for _ in range(NUM_CACHE)]
         self._bad_cache = [{} for _ in range(NUM_BAD_CACHE)]
 
-    def _sched_clean(self, intv):
-        while 1:
-            time.sleep(intv)
-            if not next(self._flip_iter):
-                self._cache_id = next(self._cache_iter)
-                self._cache[self._cache_id] = {}
-            self._bad_cache_id = next(self._bad_cache_iter)
-            self._bad_cache[self._bad_cache_id] = {}
+    def _clean(self):
+        if not next(self._flip_iter):
+            self._cache_id = next(self._cache_iter)
+            self._cache[self._cache_id] = {}
+        self._bad_cache_id = next(self._bad_cache_iter)
+        self._bad_cache[self._bad_cache_id] = {}
 
 
 dns_cache = DNS_Cache()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# coding: UTF-8
+#
+# what routing learned about a host, kept across restarts: whether direct
+# works for it and which parents served it. written to disk in the
+# background, see get_proxy.notify() for what is learned.
+
+from __future__ import division
+
+import os
+import time
+import json
+import logging
+from collections import OrderedDict
+from threading import RLock
+
+from timer_wheel import timer
+
+logger = logging.getLogger('route_memory')
+logger.setLevel(logging.INFO)
+hdr = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s %(name)s:%(levelname)s %(message)s',
+                              datefmt='%H:%M:%S')
+hdr.setFormatter(formatter)
+logger.addHandler(hdr)
+
+
+class route_memory(object):
+    '''host -> [verdict, {parent: weight}, last success, weight], least recently used dropped first.
+
+    verdict is 'direct', 'proxy' (direct failed) or None (no evidence).
+    weight counts successes since the verdict last changed and halves every
+    HALF_LIFE seconds, an entry is forgotten once it drops below MIN_WEIGHT.
+    parents are weighted the same way by the successes they served, a
+    failure halves the weight. the best parent is the heaviest one.
+    '''
+    MAX_HOSTS = 4096
+    HALF_LIFE = 86400
+    MIN_WEIGHT = 0.5
+    MAX_WEIGHT = 16
+    FLUSH_INTERVAL = 60
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = RLock()
+        self.hosts = OrderedDict()
+        self.dirty = False
+        if path:
+            self.load()
+            timer.call_every(self.FLUSH_INTERVAL, self.flush)
+
+    def _weight(self, entry, now):
+        return entry[3] * 0.5 ** ((now - entry[2]) / self.HALF_LIFE)
+
+    def _parents(self, entry, now):
+        '''parent weights decayed to now, the forgotten ones left out'''
+        decay = 0.5 ** ((now - entry[2]) / self.HALF_LIFE)
+        return dict((name, weight * decay) for name, weight in entry[1].items() if weight * decay >= self.MIN_WEIGHT)
+
+    def get(self, host):
+        '''(verdict, best parent name) or None'''
+        with self.lock:
+            entry = self.hosts.get(host)
+            if entry is None:
+                return None
+            if self._weight(entry, time.time()) < self.MIN_WEIGHT:
+                del self.hosts[host]
+                self.dirty = True
+                return None
+            parents = entry[1]
+            return entry[0], max(sorted(parents), key=parents.get) if parents else None
+
+    def learn(self, host, verdict=None, parent=None):
+        '''a request to host succeeded, None keeps what was known'''
+        now = time.time()
+        with self.lock:
+            entry = self.hosts.pop(host, None)
+            if entry is None:
+                entry = [verdict, {}, now, 1]
+            else:
+                weight = self._weight(entry, now)
+                if weight < self.MIN_WEIGHT:
+                    entry[:2], weight = [None, {}], 0
+                if verdict and verdict != entry[0]:
+                    weight = 0
+                entry = [verdict or entry[0], self._parents(entry, now), now, min(weight + 1, self.MAX_WEIGHT)]
+            if parent:
+                entry[1][parent] = min(entry[1].get(parent, 0) + 1, self.MAX_WEIGHT)
+            self.hosts[host] = entry
+            if len(self.hosts) > self.MAX_HOSTS:
+                self.hosts.popitem(last=False)
+            self.dirty = True
+
+    def failed(self, host, parent):
+        '''parent failed to serve host, it counts for half as much'''
+        with self.lock:
+            entry = self.hosts.get(host)
+            if entry is None or parent not in entry[1]:
+                return
+            entry[1][parent] /= 2
+            if entry[1][parent] < self.MIN_WEIGHT:
+                del entry[1][parent]
+            self.dirty = True
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except IOError:
+            return
+        except Exception as e:
+            logger.warning('%s is corrupted, ignored: %r' % (self.path, e))
+            return
+        now = time.time()
+        with self.lock:
+            for host, entry in sorted(data.items(), key=lambda item: item[1][2]):
+                if not isinstance(entry[1], dict):
+                    # saved with the last parent only
+                    entry[1] = {entry[1]: 1} if entry[1] else {}
+                if self._weight(entry, now) >= self.MIN_WEIGHT:
+                    self.hosts[host] = entry
+            while len(self.hosts) > self.MAX_HOSTS:
+                self.hosts.popitem(last=False)
+        logger.info('%d routes loaded from %s' % (len(self.hosts), self.path))
+
+    def flush(self):
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            data = dict((host, [entry[0], dict((name, round(weight, 2)) for name, weight in entry[1].items()), int(entry[2]), round(entry[3], 2)])
+                        for host, entry in self.hosts.items())
+            self.dirty = False
+        try:
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump(data, f, separators=(',', ':'))
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(self.path + '.tmp', self.path)
+        except Exception as e:
+            self.dirty = True
+            logger.warning('saving %s failed: %r' % (self.path, e))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: UTF-8
+import time
+import logging
+import traceback
+from threading import RLock, Thread
+
+logger = logging.getLogger('timer')
+logger.setLevel(logging.INFO)
+hdr = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s %(name)s:%(levelname)s %(message)s',
+                              datefmt='%H:%M:%S')
+hdr.setFormatter(formatter)
+logger.addHandler(hdr)
+
+SLOTS = 64
+LEVELS = 3  # with 1s ticks: 64s, 68min, 72h per level
+
+
+class timer_handle(object):
+    __slots__ = ('expires', 'interval', 'callback', 'args', 'slot', 'cancelled')
+
+    def __init__(self, expires, interval, callback, args):
+        self.expires = expires
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.slot = None
+        self.cancelled = False
+
+    def __repr__(self):
+        return '<timer_handle: %r @ tick %d>' % (self.callback, self.expires)
+
+
+class timer_wheel(object):
+    '''hierarchical timer wheel, all timers are served by one thread.
+
+    add and cancel are O(1), a timer may fire up to one tick late.
+    callbacks run on the timer thread and should return quickly.
+    '''
+    def __init__(self, tick=1.0):
+        self.tick = tick
+        self.current = 0
+        self.wheels = [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self.count = 0
+        self.lock = RLock()
+        self._thread = None
+
+    def call_later(self, delay, callback, *args):
+        return self._add(delay, 0, callback, args)
+
+    def call_every(self, interval, callback, *args):
+        return self._add(interval, interval, callback, args)
+
+    def cancel(self, handle):
+        with self.lock:
+            handle.cancelled = True
+            if handle.slot is not None:
+                handle.slot.discard(handle)
+                handle.slot = None
+                self.count -= 1
+
+    def pending(self):
+        return self.count
+
+    def _add(self, delay, interval, callback, args):
+        ticks = max(int(delay / self.tick + 0.5), 1)
+        with self.lock:
+            handle = timer_handle(self.current + ticks, interval, callback, args)
+            self._schedule(handle)
+            self.count += 1
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+        return handle
+
+    def _schedule(self, handle):
+        ticks = handle.expires - self.current
+        for level in range(LEVELS):
+            if ticks < SLOTS ** (level + 1) or level == LEVELS - 1:
+                expires = min(handle.expires, self.current + SLOTS ** LEVELS - 1)
+                slot = self.wheels[level][(expires // SLOTS ** level) % SLOTS]
+                slot.add(handle)
+                handle.slot = slot
+                return
+
+    def _cascade(self, level):
+        slot = self.wheels[level][(self.current // SLOTS ** level) % SLOTS]
+        handles = list(slot)
+        slot.clear()
+        for handle in handles:
+            self._schedule(handle)
+
+    def _advance(self):
+        '''move one tick forward, return timers due'''
+        with self.lock:
+            self.current += 1
+            for level in range(1, LEVELS):
+                if self.current % SLOTS ** level:
+                    break
+                self._cascade(level)
+            slot = self.wheels[0][self.current % SLOTS]
+            due = list(slot)
+            slot.clear()
+            for handle in due:
+                handle.slot = None
+                self.count -= 1
+        return due
+
+    def _fire(self, due):
+        for handle in due:
+            if handle.cancelled:
+                continue
+            try:
+                handle.callback(*handle.args)
+            except Exception:
+                logger.error('timer callback %r failed: %s' % (handle.callback, traceback.format_exc()))
+            with self.lock:
+                if handle.interval and not handle.cancelled:
+                    handle.expires = self.current + max(int(handle.interval / self.tick + 0.5), 1)
+                    self._schedule(handle)
+                    self.count += 1
+
+    def _run(self):
+        start = time.time()
+        while 1:
+            delay = start + (self.current + 1) * self.tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._fire(self._advance())
+
+
+timer = timer_wheel()
@@ -25,6 +25,7 @@ import struct
 import random
 import select
 import time
+from repoze.lru import lru_cache
 try:
     import configparser
 except ImportError:
@@ -140,8 +141,13 @@ except Exception:
 
 
 def ip_to_country_code(ip):
+    return _country_code(str(ip))
+
+
+@lru_cache(4096)
+def _country_code(ip):
     try:
-        resp = GeoIP2.country(str(ip))
+        resp = GeoIP2.country(ip)
         return resp.country.iso_code
     except Exception:
         return u''